@@ -0,0 +1,446 @@
+# Throughput benchmarks on a synthetic corpus, no dataset needed
+#   python -m codes.app.benchmark --config_id sample.config --output bench_output.json
+#
+# The corpus has a taxonomy of fan_out[l] children per node of level l, and document lengths
+# drawn from length_dist. Words follow a zipf distribution over a vocab of vocab_size words.
+# Measured, in docs/sec and tokens/sec (non padding tokens):
+#   preprocess : Data_Utility.preprocess of the corpus written as a WIKI csv (3 levels only)
+#   collate_fn : batching of the encoded documents
+#   <model>    : train (forward, backward and optimizer step) and infer (greedy decoding) per model
+# Every stage runs in its own process, so that its peak RSS is its own (see --in_process).
+# Model sizes, batch size and precision are read from the experiment config.
+# Results are written as json, to compare versions.
+
+import argparse
+import concurrent.futures
+import copy
+import datetime
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas
+import torch
+import torch.optim as optim
+
+from codes.models import decoders, baselines
+from codes.utils import data as data_utils
+from codes.utils import corpus as corpus_utils
+from codes.utils import model_utils as mu
+from codes.utils.config import get_config
+from codes.utils.util import get_current_commit_id
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+
+# select device automatically
+device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+
+MODELS = ['AttentiveHierarchicalClassifier', 'PooledHierarchicalClassifier',
+          'FastText', 'BiLSTM_MLP', 'SimpleDecoder']
+# pooling types of PooledHierarchicalClassifier which return an attention
+POOLED_ATTENTION_TYPES = ['maxpool']
+# number of special tokens (pad, unk) before the word ids
+NUM_SPECIAL_TOKENS = 2
+
+def get_args():
+
+    ## arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c","--config_id", type=str, help="config for the model sizes, batch size and precision",
+                        default="sample.config")
+    parser.add_argument("-o","--output", type=str, help="json file to write the results to", default="bench_output.json")
+    parser.add_argument("--models", type=str, help="comma separated models to benchmark", default=','.join(MODELS))
+    parser.add_argument("--stages", type=str, help="comma separated stages : preprocess, collate, models",
+                        default="preprocess,collate,models")
+    parser.add_argument("-n","--num_docs", type=int, help="number of synthetic documents", default=1024)
+    parser.add_argument("-f","--fan_out", type=str, help="comma separated children per node, one per level",
+                        default="4,4,4")
+    parser.add_argument("--vocab_size", type=int, help="number of distinct words", default=20000)
+    parser.add_argument("--length_dist", type=str, help="document lengths : lognormal, uniform or fixed",
+                        default="lognormal")
+    parser.add_argument("--mean_length", type=int, help="median (lognormal) or mean document length", default=100)
+    parser.add_argument("--length_sigma", type=float, help="sigma of the lognormal lengths", default=0.5)
+    parser.add_argument("--max_length", type=int, help="max document length", default=1000)
+    parser.add_argument("--warmup", type=int, help="number of untimed batches before each measure", default=2)
+    parser.add_argument("--repeats", type=int, help="number of passes over the corpus per measure", default=1)
+    parser.add_argument("--seed", type=int, help="seed of the synthetic corpus", default=1111)
+    parser.add_argument("--in_process", action="store_true",
+                        help="run all the stages in this process (the peak RSS is then cumulative)")
+
+    args = parser.parse_args()
+    return args
+
+
+class SyntheticCorpus():
+    """
+    Synthetic documents and label paths, with the label ids, taxonomy and decoder
+    labels built as in Data_Utility.preprocess. Generated from a seed, so that every
+    stage process rebuilds the same corpus.
+    """
+    def __init__(self, fan_out=(4, 4, 4), num_docs=1024, vocab_size=20000, length_dist='lognormal',
+                 mean_length=100, length_sigma=0.5, max_length=1000, seed=1111):
+        self.fan_out = list(fan_out)
+        self.vocab_size = vocab_size
+        rng = np.random.RandomState(seed)
+        # nodes per level, node i of level l is the child i % fan_out[l] of node i // fan_out[l]
+        self.label_sizes = [int(np.prod(self.fan_out[:level + 1])) for level in range(len(self.fan_out))]
+        self.label2id = {}
+        ct = 1
+        for level, size in enumerate(self.label_sizes):
+            for node in range(size):
+                self.label2id['l{}_{}'.format(level, node)] = ct
+                ct += 1
+        self.total_cats = ct
+        self.taxonomy = {0: set(self.label2id['l0_{}'.format(node)] for node in range(self.label_sizes[0]))}
+        for level in range(1, len(self.label_sizes)):
+            for node in range(self.label_sizes[level]):
+                parent = self.label2id['l{}_{}'.format(level - 1, node // self.fan_out[level])]
+                self.taxonomy.setdefault(parent, set()).add(self.label2id['l{}_{}'.format(level, node)])
+
+        # label paths, from uniformly drawn leaves
+        leaves = rng.randint(0, self.label_sizes[-1], size=num_docs)
+        self.labels = np.stack([leaves // (self.label_sizes[-1] // size) for size in self.label_sizes], 1)
+        self.decoder_labels = np.zeros((num_docs, len(self.label_sizes) + 1), dtype=corpus_utils.LABEL_DTYPE)
+        for level in range(len(self.label_sizes)):
+            self.decoder_labels[:, level + 1] = self.labels[:, level] + 1 + sum(self.label_sizes[:level])
+
+        if length_dist == 'lognormal':
+            lengths = rng.lognormal(np.log(mean_length), length_sigma, size=num_docs)
+        elif length_dist == 'uniform':
+            lengths = rng.uniform(1, 2 * mean_length, size=num_docs)
+        elif length_dist == 'fixed':
+            lengths = np.full(num_docs, mean_length)
+        else:
+            raise NotImplementedError("length_dist {} not implemented".format(length_dist))
+        lengths = np.clip(np.round(lengths), 1, max_length).astype(np.int64)
+        offsets = np.zeros(num_docs + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(lengths)
+        # zipf word frequencies, word w has the id w + NUM_SPECIAL_TOKENS
+        freqs = 1.0 / np.arange(1, vocab_size + 1)
+        words = rng.choice(vocab_size, size=int(offsets[-1]), p=freqs / freqs.sum())
+        tokens = (words + NUM_SPECIAL_TOKENS).astype(corpus_utils.TOKEN_DTYPE)
+        self.docs = corpus_utils.EncodedCorpus(tokens, offsets)
+
+    def num_tokens(self):
+        return int(self.docs.lengths().sum())
+
+    def texts(self):
+        return [' '.join('w{}'.format(word - NUM_SPECIAL_TOKENS) for word in self.docs[i])
+                for i in range(len(self.docs))]
+
+    def write_wiki_csv(self, data_loc):
+        """
+        Write the corpus in the WIKI format read by Data_Utility.preprocess
+        """
+        if len(self.label_sizes) != 3:
+            raise RuntimeError("the WIKI format has exactly 3 levels")
+        df = pandas.DataFrame({'l{}'.format(level + 1): ['c{}_{}'.format(level, node) for node in self.labels[:, level]]
+                               for level in range(3)})
+        df['text'] = self.texts()
+        df.to_csv(os.path.join(data_loc, 'wiki_data.csv'), index=False)
+
+    def batches(self, batch_size, targets=None):
+        """
+        Collated batches over the corpus, in order
+        :param targets: target rows, the decoder labels if None
+        :return: list of Batch
+        """
+        if targets is None:
+            targets = self.decoder_labels
+        dataset = data_utils.TextDataLoader(self.docs, targets)
+        return [data_utils.collate_fn([dataset[i] for i in range(start, min(start + batch_size, len(dataset)))])
+                for start in range(0, len(dataset), batch_size)]
+
+
+def peak_rss_mb():
+    """
+    Peak resident memory of this process
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    if sys.platform == 'darwin':
+        return peak / 2 ** 20
+    return peak / 2 ** 10
+
+def synchronize():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+def throughput(seconds, docs, tokens, batches):
+    return {
+        'seconds': seconds,
+        'batches': batches,
+        'docs': docs,
+        'tokens': tokens,
+        'docs_per_sec': docs / seconds if seconds > 0 else float('nan'),
+        'tokens_per_sec': tokens / seconds if seconds > 0 else float('nan')
+    }
+
+def measure(fn, batches, warmup=2, repeats=1):
+    """
+    Run fn on every batch, repeats times, after warmup untimed batches
+    :return: throughput
+    """
+    for batch in batches[:warmup]:
+        fn(batch)
+    synchronize()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for batch in batches:
+            fn(batch)
+    synchronize()
+    seconds = time.perf_counter() - start
+    return throughput(seconds,
+                      repeats * sum(batch.inp.size(0) for batch in batches),
+                      repeats * sum(sum(batch.inp_lengths) for batch in batches),
+                      repeats * len(batches))
+
+def get_corpus(settings):
+    return SyntheticCorpus(fan_out=settings['fan_out'], num_docs=settings['num_docs'],
+                           vocab_size=settings['vocab_size'], length_dist=settings['length_dist'],
+                           mean_length=settings['mean_length'], length_sigma=settings['length_sigma'],
+                           max_length=settings['max_length'], seed=settings['seed'])
+
+def bench_preprocess(config, settings):
+    corpus = get_corpus(settings)
+    if len(corpus.label_sizes) != 3:
+        return {'skipped': "Data_Utility.preprocess reads 3 levels, the taxonomy has {}".format(
+            len(corpus.label_sizes))}
+    data_loc = tempfile.mkdtemp(prefix='hier_class_bench_')
+    try:
+        corpus.write_wiki_csv(data_loc)
+        config = copy.deepcopy(config)
+        # absolute paths, both the csv and the processed corpus stay in the temporary folder
+        config.update({'data_type': 'WIKI', 'data_loc': data_loc, 'data_path': data_loc,
+                       'level': -1, 'decoder_ready': True})
+        data = data_utils.Data_Utility(config)
+        start = time.perf_counter()
+        data.preprocess()
+        seconds = time.perf_counter() - start
+    finally:
+        shutil.rmtree(data_loc, ignore_errors=True)
+    result = throughput(seconds, len(corpus.docs), corpus.num_tokens(), 0)
+    result['peak_rss_mb'] = peak_rss_mb()
+    return result
+
+def bench_collate(config, settings):
+    corpus = get_corpus(settings)
+    dataset = data_utils.TextDataLoader(corpus.docs, corpus.decoder_labels)
+    batch_size = config['batch_size']
+    index_batches = [list(range(start, min(start + batch_size, len(dataset))))
+                     for start in range(0, len(dataset), batch_size)]
+    start = time.perf_counter()
+    for _ in range(settings['repeats']):
+        for indices in index_batches:
+            data_utils.collate_fn([dataset[i] for i in indices])
+    seconds = time.perf_counter() - start
+    result = throughput(seconds, settings['repeats'] * len(dataset),
+                        settings['repeats'] * corpus.num_tokens(), settings['repeats'] * len(index_batches))
+    result['peak_rss_mb'] = peak_rss_mb()
+    return result
+
+def build_model(name, config, corpus):
+    """
+    Build the model with the parameters of run_experiment, for the synthetic taxonomy
+    :return: model, train step loss function, infer function
+    """
+    levels = len(corpus.label_sizes)
+    model_params = copy.deepcopy(config)
+    model_params.update({
+        'vocab_size': corpus.vocab_size + NUM_SPECIAL_TOKENS,
+        'label_size': corpus.total_cats,
+        'embedding': None,
+        'use_embedding': False,
+        'pad_token': 0,
+        'total_cats': corpus.total_cats,
+        'taxonomy': corpus.taxonomy,
+        'label_sizes': corpus.label_sizes,
+        'label2id': corpus.label2id,
+        'levels': levels,
+        'level': -1,
+        'max_categories': levels,
+        'gpu': config['gpu']
+    })
+    if len(model_params['loss_focus']) < levels:
+        model_params['loss_focus'] = [1] * levels
+
+    if name in ['AttentiveHierarchicalClassifier', 'PooledHierarchicalClassifier']:
+        if name == 'AttentiveHierarchicalClassifier':
+            model = decoders.AttentiveHierarchicalClassifier(**model_params)
+        else:
+            if model_params['attention_type'] not in POOLED_ATTENTION_TYPES:
+                model_params['attention_type'] = POOLED_ATTENTION_TYPES[0]
+            model = decoders.PooledHierarchicalClassifier(**model_params)
+        model = model.to(device)
+        trainer = decoders.Trainer(model=model, loss_weights=None, **model_params)
+
+        def train_loss(batch):
+            (loss, _), *_ = trainer.batchNLLLoss(batch.inp, batch.inp_lengths, batch.outp,
+                                                 mode='train', tf_ratio=config['tf_ratio'])
+            return loss
+
+        def infer(batch):
+            return trainer.predict(batch.inp, batch.inp_lengths)
+
+    elif name in ['FastText', 'BiLSTM_MLP']:
+        # baselines classify the last level only, with its own label ids
+        model_params['label_size'] = corpus.label_sizes[-1] + 1
+        if name == 'FastText':
+            model = baselines.FastText(**model_params)
+        else:
+            model = baselines.BiLSTM_MLP(**model_params)
+        model = model.to(device)
+
+        def train_loss(batch):
+            loss, *_ = model.batchNLLLoss(batch.inp, batch.inp_lengths, batch.outp, target_level=1)
+            return loss
+
+        def infer(batch):
+            return torch.max(model(batch.inp, batch.inp_lengths), 1)[1]
+
+    elif name == 'SimpleDecoder':
+        if levels != 3:
+            raise NotImplementedError("SimpleDecoder decodes 3 levels, the taxonomy has {}".format(levels))
+        model = decoders.SimpleDecoder(**model_params).to(device)
+
+        def train_loss(batch):
+            loss, _ = model.batchNLLLoss(batch.inp, batch.inp_lengths, batch.outp,
+                                         tf_ratio=config['tf_ratio'], loss_focus=model_params['loss_focus'])
+            return loss
+
+        def infer(batch):
+            # greedy decoding, without teacher forcing
+            return model.batchNLLLoss(batch.inp, batch.inp_lengths, batch.outp,
+                                      tf_ratio=0, loss_focus=model_params['loss_focus'])
+    else:
+        raise NotImplementedError("model {} not implemented".format(name))
+    return model, train_loss, infer
+
+def bench_model(config, settings, name):
+    torch.manual_seed(settings['seed'])
+    corpus = get_corpus(settings)
+    model, train_loss, infer = build_model(name, config, corpus)
+    targets = None
+    if name in ['FastText', 'BiLSTM_MLP']:
+        targets = np.zeros((len(corpus.docs), 2), dtype=corpus_utils.LABEL_DTYPE)
+        targets[:, 1] = corpus.labels[:, -1]
+    batches = corpus.batches(config['batch_size'], targets)
+    for batch in batches:
+        batch.to_device(device)
+
+    m_params = [p for p in model.parameters() if p.requires_grad]
+    optimizer = optim.Adam(m_params, lr=config['lr'])
+    mixed_precision = mu.MixedPrecision(config.get('precision', 'fp32'), device_type=device.type)
+
+    def train_step(batch):
+        optimizer.zero_grad()
+        with mixed_precision.autocast():
+            loss = train_loss(batch)
+        mixed_precision.backward(loss)
+        mixed_precision.step(optimizer, m_params, config['clip_grad'])
+
+    def infer_step(batch):
+        with torch.no_grad(), mixed_precision.autocast():
+            infer(batch)
+
+    result = {'parameters': int(sum(np.prod(p.size()) for p in m_params))}
+    model.train()
+    result['train'] = measure(train_step, batches, settings['warmup'], settings['repeats'])
+    model.eval()
+    result['infer'] = measure(infer_step, batches, settings['warmup'], settings['repeats'])
+    result['peak_rss_mb'] = peak_rss_mb()
+    if torch.cuda.is_available():
+        result['peak_cuda_mb'] = torch.cuda.max_memory_allocated() / 2 ** 20
+    return result
+
+def run_stage(in_process, fn, *args):
+    """
+    Run a benchmark stage in a new process (or in this one), errors are recorded in the results
+    """
+    try:
+        if in_process:
+            return fn(*args)
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            return executor.submit(fn, *args).result()
+    except Exception as e:
+        logging.exception("Benchmark stage failed")
+        return {'error': '{}: {}'.format(type(e).__name__, e)}
+
+def get_commit():
+    try:
+        return get_current_commit_id()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    args = get_args()
+    config = get_config(config_id=args.config_id)
+    settings = {
+        'fan_out': [int(f) for f in args.fan_out.split(',')],
+        'num_docs': args.num_docs,
+        'vocab_size': args.vocab_size,
+        'length_dist': args.length_dist,
+        'mean_length': args.mean_length,
+        'length_sigma': args.length_sigma,
+        'max_length': args.max_length,
+        'warmup': args.warmup,
+        'repeats': args.repeats,
+        'seed': args.seed
+    }
+    corpus = get_corpus(settings)
+    lengths = corpus.docs.lengths()
+    stages = args.stages.split(',')
+    results = {
+        'date': datetime.datetime.now().isoformat(),
+        'commit': get_commit(),
+        'config_id': args.config_id,
+        'environment': {
+            'python': platform.python_version(),
+            'torch': torch.__version__,
+            'device': str(device),
+            'threads': torch.get_num_threads(),
+            'platform': platform.platform()
+        },
+        'settings': settings,
+        'model_config': {key: config.get(key) for key in ['batch_size', 'precision', 'embedding_dim',
+                                                          'mlp_hidden_dim', 'cat_emb_dim', 'n_layers',
+                                                          'n_heads', 'da', 'use_rnn', 'renormalize',
+                                                          'batched_attention', 'tf_ratio']},
+        'corpus': {
+            'label_sizes': corpus.label_sizes,
+            'tokens': int(lengths.sum()),
+            'mean_length': float(lengths.mean()),
+            'max_length': int(lengths.max())
+        },
+        'results': {}
+    }
+    del corpus
+    if 'preprocess' in stages:
+        logging.info("Benchmarking preprocess")
+        results['results']['preprocess'] = run_stage(args.in_process, bench_preprocess, config, settings)
+    if 'collate' in stages:
+        logging.info("Benchmarking collate_fn")
+        results['results']['collate_fn'] = run_stage(args.in_process, bench_collate, config, settings)
+    if 'models' in stages:
+        results['results']['models'] = {}
+        for name in args.models.split(','):
+            logging.info("Benchmarking {}".format(name))
+            results['results']['models'][name] = run_stage(args.in_process, bench_model, config, settings, name)
+    results['peak_rss_mb'] = peak_rss_mb()
+    with open(args.output, 'w') as fp:
+        json.dump(results, fp, indent=2)
+    logging.info("Results written to {}".format(args.output))
@@ -10,6 +10,7 @@ from codes.experiments.hier_classifier import run_experiment
 from codes.utils.config import get_config
 from codes.utils.util import set_seed
 from codes.utils.argument_parser import argument_parser
+from codes.utils import distributed
 import os
 from addict import Dict
 import logging
@@ -39,7 +40,8 @@ if __name__ == '__main__':
         options['--mongo_db'] = '{}:{}:{}'.format(config.log.mongo_host,
                                         config.log.mongo_port,
                                         config.log.mongo_db)
-    else:
+    elif distributed.env_rank() == 0:
+        # with multiple processes, only the main one records the run
         base_path = str(os.path.dirname(os.path.realpath(__file__)).split('/codes')[0])
         log_path = os.path.join(base_path, config.logging.dir)
         ex.observers.append(FileStorageObserver.create(log_path))
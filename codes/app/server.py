@@ -0,0 +1,311 @@
+# Long running inference server for a saved hierarchical classifier
+# Requests are micro-batched: documents arriving within max_wait_ms of each other
+# (up to max_batch_size documents) are classified together in one model call.
+#
+# POST /predict {"text": "..."}              -> {"prediction": {...}}
+# POST /predict {"documents": ["...", ...]}  -> {"predictions": [{...}, ...]}
+# GET  /health                               -> {"status": "ok"}
+#
+# With --beam_size k, each prediction also holds the top k label paths and their scores.
+
+import argparse
+import json
+import os
+import queue
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from os.path import dirname, abspath
+
+import torch
+
+from codes.models import decoders
+from codes.utils import data as data_utils
+from codes.utils import constants
+
+import logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+
+# select device automatically
+device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+
+def get_args():
+
+    ## arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-e","--exp", type=str, help="experiment to load", required=True)
+    parser.add_argument("-m","--model", type=str, help="model to load", default="model_epoch_0_step_0.mod")
+    parser.add_argument("--host", type=str, help="host to listen on", default="127.0.0.1")
+    parser.add_argument("-p","--port", type=int, help="port to listen on", default=8000)
+    parser.add_argument("-s","--socket", type=str, help="listen on this unix socket instead of host / port", default="")
+    parser.add_argument("-b","--max_batch_size", type=int, help="max documents per model call", default=64)
+    parser.add_argument("-w","--max_wait_ms", type=float, help="max time to wait for a batch to fill", default=5)
+    parser.add_argument("--warmup", type=int, help="number of warm up batches", default=3)
+    parser.add_argument("-k","--beam_size", type=int, help="also return the top k label paths, with beam search", default=1)
+
+    args = parser.parse_args()
+    return args
+
+
+class Predictor():
+    """
+    Load a saved model with its data utility, and predict the label path of documents
+    """
+    def __init__(self, exp, model_name, beam_size=1):
+        base_dir = str(dirname(abspath(__file__)).split('codes')[0])
+        save_path_base = os.path.join(base_dir, 'saved', exp)
+        model_params = json.load(open(os.path.join(save_path_base, 'parameters.json'), 'r'))
+        ## load embeddings if any
+        if model_params['use_embedding']:
+            emb_path_base = base_dir + 'data/' + model_params['data_path']
+            model_params['embedding'] = torch.load(open(emb_path_base + model_params['embedding_saved'], 'rb'))
+        logging.info("Loading the data")
+        self.data = data_utils.Data_Utility(model_params)
+        self.data.load()
+        model_params['taxonomy'] = self.data.taxonomy
+        if model_params['model_type'] == 'attentive':
+            model = decoders.AttentiveHierarchicalClassifier(**model_params)
+        elif model_params['model_type'] == 'pooling':
+            model = decoders.PooledHierarchicalClassifier(**model_params)
+        else:
+            raise NotImplementedError("model_type {} not implemented".format(model_params['model_type']))
+        logging.info("Loading the model")
+        model.load_state_dict(torch.load(os.path.join(save_path_base, model_name), map_location=device))
+        model = model.to(device)
+        model.eval()
+        self.trainer = decoders.Trainer(model=model, **model_params)
+        self.levels = len(model_params['label_sizes'])
+        self.unk = self.data.word2id[constants.UNK_WORD]
+        label_size = sum(model_params['label_sizes']) + 1
+        if beam_size > label_size:
+            # there can not be more paths than classes per level, the extra beams would only be -inf padding
+            logging.warning("beam_size {} is larger than the number of classes, using {}".format(beam_size, label_size))
+            beam_size = label_size
+        self.beam_size = beam_size
+
+    def encode(self, text):
+        """
+        tokenize and map a raw document to word ids
+        """
+        ids = [self.data.word2id.get(w, self.unk) for w in self.data.tokenize(str(text).lower())]
+        if len(ids) == 0:
+            ids = [self.unk]
+        return ids
+
+    def decode_label(self, level, label_id):
+        """
+        map a decoder label id back to its class name
+        """
+        label = int(self.data.id2label[label_id].split('_')[1])
+        return str(self.data.y_id2class['l' + str(level + 1)][label])
+
+    def predict(self, docs):
+        """
+        :param docs: list of word id lists
+        :return: list of predictions, one per document, with the label id, class and confidence per level.
+            With beam search, the levels are the ones of the best path, and the top k paths
+            are returned as well with their joint log probability
+        """
+        rows = [(ids, [0] * (self.levels + 1), [i]) for i, ids in enumerate(docs)]
+        batch = data_utils.collate_fn(rows)
+        batch.to_device(device)
+        if self.beam_size > 1:
+            paths, scores, confs = self.trainer.beam_predict(batch.inp, batch.inp_lengths,
+                                                             beam_size=self.beam_size)
+            paths = paths.cpu().numpy()
+            scores = scores.cpu().numpy()
+            confs = confs.cpu().numpy()
+        else:
+            preds, confs, _, _ = self.trainer.predict(batch.inp, batch.inp_lengths)
+            paths = preds.unsqueeze(1).cpu().numpy()
+            confs = confs.unsqueeze(1).cpu().numpy()
+        results = [None] * len(docs)
+        for pos, row in enumerate(batch.src_indexes):
+            result = {'levels': self.decode_path(paths[pos, 0], confs[pos, 0])}
+            if self.beam_size > 1:
+                result['paths'] = [{'levels': self.decode_path(paths[pos, k], confs[pos, k]),
+                                    'score': float(scores[pos, k])}
+                                   for k in range(paths.shape[1]) if scores[pos, k] > -float('inf')]
+            results[row[0]] = result
+        return results
+
+    def decode_path(self, path, confs):
+        """
+        :param path: label id per level
+        :param confs: confidence per level
+        :return: list with the label id, class and confidence per level
+        """
+        levels = []
+        for level in range(self.levels):
+            label_id = int(path[level])
+            levels.append({
+                'label_id': label_id,
+                'label': self.decode_label(level, label_id),
+                'confidence': float(confs[level])
+            })
+        return levels
+
+
+class PendingRequest():
+    """
+    Documents of one request waiting for their predictions
+    """
+    def __init__(self, docs):
+        self.docs = docs
+        self.results = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class MicroBatcher(threading.Thread):
+    """
+    Collect concurrent requests into batches. A batch is run as soon as it has
+    max_batch_size documents, or max_wait seconds after its first request arrived.
+    All model calls happen on this thread.
+    """
+    def __init__(self, predictor, max_batch_size=64, max_wait=0.005):
+        super(MicroBatcher, self).__init__(daemon=True)
+        self.predictor = predictor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+
+    def submit(self, docs):
+        """
+        Queue the documents and block until they are predicted
+        """
+        request = PendingRequest(docs)
+        self.queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.results
+
+    def run(self):
+        while True:
+            pending = [self.queue.get()]
+            size = len(pending[0].docs)
+            deadline = time.time() + self.max_wait
+            while size < self.max_batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                pending.append(request)
+                size += len(request.docs)
+            self.process(pending)
+
+    def process(self, pending):
+        docs = [doc for request in pending for doc in request.docs]
+        try:
+            results = []
+            for start in range(0, len(docs), self.max_batch_size):
+                results.extend(self.predictor.predict(docs[start:start + self.max_batch_size]))
+            pos = 0
+            for request in pending:
+                request.results = results[pos:pos + len(request.docs)]
+                pos += len(request.docs)
+        except Exception as e:
+            logging.exception("Prediction failed")
+            for request in pending:
+                request.error = e
+        finally:
+            for request in pending:
+                request.done.set()
+
+
+class PredictionHandler(BaseHTTPRequestHandler):
+    """
+    HTTP handler, the batcher is set on the server
+    """
+    def send_json(self, code, body):
+        body = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self.send_json(200, {'status': 'ok'})
+        else:
+            self.send_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if self.path != '/predict':
+            self.send_json(404, {'error': 'not found'})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            single = 'text' in request
+            texts = [request['text']] if single else request['documents']
+            if not isinstance(texts, list):
+                raise ValueError("documents should be a list")
+        except (ValueError, KeyError, TypeError) as e:
+            self.send_json(400, {'error': 'bad request: {}'.format(e)})
+            return
+        batcher = self.server.batcher
+        try:
+            results = batcher.submit([batcher.predictor.encode(text) for text in texts])
+        except Exception as e:
+            self.send_json(500, {'error': str(e)})
+            return
+        if single:
+            self.send_json(200, {'prediction': results[0]})
+        else:
+            self.send_json(200, {'predictions': results})
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def warmup(predictor, max_batch_size, num_batches=3):
+    """
+    Run a few batches of increasing length so that the first requests
+    do not pay for lazy initialization and allocator growth
+    """
+    for i in range(num_batches):
+        doc_len = 16 * (4 ** i)
+        predictor.predict([[predictor.unk] * doc_len] * max_batch_size)
+
+
+def serve(args):
+    predictor = Predictor(args.exp, args.model, beam_size=args.beam_size)
+    logging.info("Warming up")
+    warmup(predictor, args.max_batch_size, args.warmup)
+    batcher = MicroBatcher(predictor, max_batch_size=args.max_batch_size,
+                           max_wait=args.max_wait_ms / 1000.0)
+    batcher.start()
+    if args.socket:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        server = ThreadingUnixHTTPServer(args.socket, PredictionHandler)
+        logging.info("Serving on unix socket {}".format(args.socket))
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), PredictionHandler)
+        logging.info("Serving on {}:{}".format(args.host, args.port))
+    server.batcher = batcher
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    serve(get_args())
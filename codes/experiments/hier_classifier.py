@@ -14,6 +14,8 @@ from codes.utils import data as data_utils
 from codes.models import decoders, baselines
 from codes.utils import constants as CONSTANTS
 from codes.utils import model_utils as mu
+from codes.utils import distributed
+from codes.utils.profiler import profiler
 from codes.utils.stats import Statistics
 from codes.utils.evaluate import evaluate_test
 
@@ -22,6 +24,8 @@ from codes.utils.evaluate import evaluate_test
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
 def run_experiment(config, _run):
+    # join the other processes when running data parallel
+    rank, world_size = distributed.init(config.get('dist_backend', 'gloo'))
     # set seed
     torch.manual_seed(config['seed'])
     if torch.cuda.is_available():
@@ -30,16 +34,22 @@ def run_experiment(config, _run):
     if len(config['exp_name']) < 1:
         config['exp_name'] = _run.start_time.strftime('%Y_%m_%d_%H_%M_%S')
     # if experiment folder exists, append timestamp after
+    # (unless resuming the experiment from its checkpoints)
     base_dir = str(os.path.dirname(os.path.realpath(__file__)).split('codes')[0])
     exp_log_dir = os.path.join(base_dir, 'logs')
-    if os.path.exists(os.path.join(exp_log_dir, config['exp_name'])):
+    if not config['load_model'] and os.path.exists(os.path.join(exp_log_dir, config['exp_name'])):
         config['exp_name'] = os.path.join(config['exp_name'], _run.start_time.strftime('%Y_%m_%d_%H_%M_%S'))
     data = data_utils.Data_Utility(config)
     max_categories = config['levels']
     if config['level'] != -1:
         max_categories = 1
     logging.info("Loading data")
+    # the main process preprocesses the data (if needed) before the others load it
+    if not distributed.is_main():
+        distributed.barrier()
     data.load()
+    if distributed.is_main():
+        distributed.barrier()
 
     batch_size = config['batch_size']
     gpu = config['gpu']
@@ -68,7 +78,8 @@ def run_experiment(config, _run):
         embedding = data.load_embedding(config['embedding_file'],
                                         config['embedding_saved'],
                                         embedding_dim=config['embedding_dim'],
-                                        data_path=config['data_path'])
+                                        data_path=config['data_path'],
+                                        use_cache=config.get('embedding_cache', False))
     model_params.update({
         'vocab_size': len(data.word2id),
         'label_size': label_size,
@@ -147,6 +158,11 @@ def run_experiment(config, _run):
         raise NotImplementedError()
 
     model = model.to(device)
+    distributed.broadcast_parameters(model)
+
+    # gradient accumulation, one optimizer step every accumulation_steps batches
+    accumulation_steps = max(config.get('accumulation_steps', 1), 1)
+    logging.info("Gradient accumulation steps : {}".format(accumulation_steps))
 
     # set learning rate scheduler
     if config['lr_scheduler'] == 'plateau':
@@ -158,16 +174,28 @@ def run_experiment(config, _run):
                                          cooldown=1,
                                          verbose=True)
     elif config['lr_scheduler'] == 'sltr':
+        # one scheduler step per optimizer step, the first process has the largest shard of rows
         lr_scheduler = mu.SLTR(epochs=config['epochs'],
-                           batch_size=config['batch_size'],
-                           num_train=len(data.train_indices))
+                           batch_size=config['batch_size'] * accumulation_steps,
+                           num_train=(len(data.train_indices) + world_size - 1) // world_size)
     else:
         raise NotImplementedError("lr_scheduler {} not implemented".format(config['lr_scheduler']))
 
+    # mixed precision
+    precision = config.get('precision', 'fp32')
+    mixed_precision = mu.MixedPrecision(precision, device_type=device.type)
+    logging.info("Precision : {}".format(precision))
+
     # create trainer
     trainer = decoders.Trainer(model=model, loss_weights=label_weights,
                                **model_params)
 
+    # fast train : no host syncs in the training steps
+    fast_train = config.get('fast_train', False)
+    if fast_train:
+        logging.info("Fast train, metrics reduced every {} steps".format(config.get('metrics_interval', 50)))
+        trainer.check_categories(data.targets)
+
     tf_ratio = config['tf_ratio']
     logging.info("Starting to train")
     pytorch_version = torch.__version__
@@ -176,31 +204,73 @@ def run_experiment(config, _run):
     max_levels = config['levels']
     if config['level'] != -1:
         max_levels = 1
-    stats = Statistics(batch_size, max_levels, config['exp_name'], data=data, n_heads=config['n_heads'], level=config['level'])
+    stats = Statistics(batch_size, max_levels, config['exp_name'], data=data, n_heads=config['n_heads'], level=config['level'],
+                       keep_predictions=config.get('keep_predictions', False),
+                       metrics_interval=config.get('metrics_interval', 50))
+    # time the stages of the training steps
+    profiler.configure(enabled=config.get('profile', False), writer=stats.writer)
     logging.info("With focus : {}".format(config['loss_focus']))
+
+    # resume from a checkpoint
+    start_epoch = 0
+    if config['load_model']:
+        checkpoint = mu.load_checkpoint(config['exp_name'], config['load_model_path'])
+        if checkpoint is None:
+            logging.info("No checkpoint to resume from, starting from scratch")
+        else:
+            model.load_state_dict(checkpoint['model'])
+            optimizer.load_state_dict(checkpoint['optimizer'])
+            lr_scheduler.load_state_dict(checkpoint['lr_scheduler'])
+            mixed_precision.load_state_dict(checkpoint['mixed_precision'])
+            stats.load_state_dict(checkpoint['stats'])
+            mu.set_rng_state(checkpoint['rng'])
+            tf_ratio = checkpoint['tf_ratio']
+            start_epoch = checkpoint['epoch'] + 1
+            logging.info("Resuming after epoch {}".format(checkpoint['epoch']))
+            del checkpoint
+    mu.save_parameters(config['exp_name'], model_params)
+    # models and checkpoints are written in the background if async_checkpoint
+    checkpoint_writer = mu.CheckpointWriter(async_write=config.get('async_checkpoint', False))
+
     all_step = 0
-    for epoch in range(epochs):
+    for epoch in range(start_epoch, epochs):
         stats.next()
         logging.info("Getting data")
         logging.info("Num Train Rows: {}".format(len(data.train_indices)))
         logging.info("Num Test Rows: {}".format(len(data.test_indices)))
         logging.info("TF Ratio: {}".format(tf_ratio))
-        train_data_loader = data.get_dataloader(mode='train')
+        train_data_loader = data.get_dataloader(mode='train', epoch=epoch)
         model.train()
         loss = None
-        for batch_idx, batch in enumerate(train_data_loader):
-            if config['lr_scheduler'] == 'sltr':
-                optimizer = lr_scheduler.step(optimizer)
-            optimizer.zero_grad()
-            batch.to_device(device)
-            (loss, log_loss), accs, attns, *_ = trainer.batchNLLLoss(batch.inp, batch.inp_lengths,
-                                            batch.outp,mode='train', tf_ratio=config['tf_ratio'])
-            torch.cuda.empty_cache()
-            loss.backward()
-            m_params = [p for p in model.parameters() if p.requires_grad]
-            nn.utils.clip_grad_norm(m_params, config['clip_grad'])
-            optimizer.step()
-            stats.update_train(loss.item(), accs, log_loss=log_loss.item())
+        # number of batches accumulated since the last optimizer step
+        accumulated = 0
+        train_batches = profiler.iterate(distributed.even_batches(train_data_loader), 'data')
+        for batch_idx, batch in enumerate(train_batches):
+            if accumulated == 0:
+                if config['lr_scheduler'] == 'sltr':
+                    optimizer = lr_scheduler.step(optimizer)
+                optimizer.zero_grad()
+            with profiler.timer('to_device'):
+                batch.to_device(device)
+            with mixed_precision.autocast():
+                (loss, log_loss), accs, attns, *_ = trainer.batchNLLLoss(batch.inp, batch.inp_lengths,
+                                                batch.outp,mode='train', tf_ratio=tf_ratio)
+            if not fast_train:
+                torch.cuda.empty_cache()
+            # average the gradients over the accumulated batches
+            with profiler.timer('backward'):
+                mixed_precision.backward(loss / accumulation_steps)
+            accumulated += 1
+            if accumulated == accumulation_steps:
+                with profiler.timer('optimizer'):
+                    mixed_precision.step(optimizer, m_params, config['clip_grad'])
+                accumulated = 0
+            if fast_train:
+                stats.update_train_device(loss, accs, log_loss)
+            else:
+                stats.update_train(loss.item(), accs, log_loss=log_loss.item())
+            stats.update_padding(batch.inp_lengths)
+            profiler.step()
             ## free up memory
             del batch
             del loss
@@ -208,6 +278,11 @@ def run_experiment(config, _run):
             del attns
             if config['debug']:
                 break
+        if accumulated > 0:
+            # last, shorter, accumulation window of the epoch
+            with profiler.timer('optimizer'):
+                mixed_precision.step(optimizer, m_params, config['clip_grad'],
+                                     grad_factor=accumulation_steps / accumulated)
         ## validate
         model.eval()
         ## store the attention weights and words in a separate file for
@@ -215,29 +290,21 @@ def run_experiment(config, _run):
         storage = []
         test_data_loader = data.get_dataloader(mode='test')
         valid_losses = []
-        with torch.no_grad():
+        with torch.no_grad(), profiler.paused():
             for batch_idx, batch in enumerate(test_data_loader):
                 batch.to_device(device)
-                ## overall - teacher_forcing false
-                (loss, log_loss), accs, attns, preds, correct, correct_confs, incorrect_confs,_ = trainer.batchNLLLoss(
-                    batch.inp, batch.inp_lengths, batch.outp, mode='infer',overall=True)
-                stats.update_validation(loss.item(),accs, attn=attns, src=batch.inp, preds=preds, correct=correct,
-                                        correct_confs=correct_confs,
-                                        incorrect_confs=incorrect_confs,
-                                        log_loss=log_loss.item(),
-                                        mode='overall')
-                valid_losses.append(loss.item())
-
-                ## exact - teacher_forcing true
-                (loss, log_loss), accs, attns, preds, correct, correct_confs, incorrect_confs,_ = trainer.batchNLLLoss(
-                    batch.inp, batch.inp_lengths, batch.outp, mode='infer', overall=False)
-                stats.update_validation(loss.item(), accs, attn=attns, src=batch.inp, preds=preds, correct=correct,
-                                        correct_confs=correct_confs,
-                                        incorrect_confs=incorrect_confs,
-                                        log_loss=log_loss.item(),
-                                        mode='exact')
-
-                valid_losses.append(loss.item())
+                ## overall - teacher_forcing false, exact - teacher_forcing true
+                ## both decoded from a single encoder pass
+                with mixed_precision.autocast():
+                    outputs = trainer.inferenceNLLLoss(batch.inp, batch.inp_lengths, batch.outp)
+                for mode in ['overall', 'exact']:
+                    (loss, log_loss), accs, attns, preds, correct, correct_confs, incorrect_confs,_ = outputs[mode]
+                    stats.update_validation(loss.item(),accs, attn=attns, src=batch.inp, preds=preds, correct=correct,
+                                            correct_confs=correct_confs,
+                                            incorrect_confs=incorrect_confs,
+                                            log_loss=log_loss.item(),
+                                            mode=mode)
+                    valid_losses.append(loss.item())
 
                 del batch
                 del loss
@@ -247,7 +314,8 @@ def run_experiment(config, _run):
                 if config['debug']:
                     break
             stats.log_loss()
-            valid_loss = np.mean(valid_losses)
+            profiler.summary(epoch)
+            valid_loss = distributed.all_mean(valid_losses)
             #valid_acc_lr = stats.get_valid_acc(config['levels'] - 1)
             #print('valid_acc_lr {}'.format(valid_acc_lr))
             if config['lr_scheduler'] == 'plateau':
@@ -255,8 +323,22 @@ def run_experiment(config, _run):
             stats.reset()
             ## anneal
             tf_ratio = tf_ratio * config['tf_anneal']
-            ## saving model
-            mu.save_model(model, epoch, 0, config['exp_name'], model_params)
+            ## saving model, written along with the checkpoint from a single snapshot
+            mu.save_checkpoint({
+                'epoch': epoch,
+                'model': model.state_dict(),
+                'optimizer': optimizer.state_dict(),
+                'lr_scheduler': lr_scheduler.state_dict(),
+                'mixed_precision': mixed_precision.state_dict(),
+                'stats': stats.state_dict(),
+                'rng': mu.get_rng_state(),
+                'tf_ratio': tf_ratio
+            }, config['exp_name'], epoch, valid_loss=valid_loss,
+                keep_last=config.get('keep_last_checkpoints', 0),
+                keep_best=config.get('keep_best_checkpoint', True),
+                writer=checkpoint_writer,
+                model_file=model_params['save_name'].format(epoch, 0))
+    checkpoint_writer.wait()
     ## Evaluate Testing data
     ## trainer.model.eval()
     ## evaluate_test(trainer, data, config['test_file_name'], config['test_output_name'], config)
@@ -5,10 +5,11 @@ import torch.nn.functional as F
 import torch.nn.init as init
 from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 import random
-from codes.models.sublayers import DocumentLevelScaledAttention, DocumentLevelSelfAttention
+from codes.models.sublayers import DocumentLevelScaledAttention, DocumentLevelSelfAttention, LevelClassifier
 from codes.utils.masked_softmax import MaskedSoftmaxAndLogSoftmax
 from codes.utils.model_utils import get_mlp
 from codes.utils import constants as Constants
+from codes.utils.profiler import profiler
 import numpy as np
 import time
 import pdb
@@ -186,6 +187,8 @@ class AttentiveHierarchicalClassifier(nn.Module):
                  use_parent_emb=False,
                  use_projection=True,
                  label_sizes=[],
+                 batched_attention=False,
+                 level_heads=False,
                  **kwargs):
         """
 
@@ -206,6 +209,11 @@ class AttentiveHierarchicalClassifier(nn.Module):
         :param fix_embedding:
         :param multi_class:
         :param use_rnn:
+        :param batched_attention: run the self attention over the padded batch in one call
+        :param level_heads: the classifier of each level only outputs the classes of its level
+            (in the global label id space), instead of all the classes. The heads only run as one
+            grouped matmul when the levels are decoded in one pass (Trainer parallel_levels),
+            otherwise each decoding step runs the head of its level
         :param kwargs:
         """
         super(AttentiveHierarchicalClassifier, self).__init__()
@@ -223,6 +231,7 @@ class AttentiveHierarchicalClassifier(nn.Module):
         self.pretrained_lm = pretrained_lm
         self.use_parent_emb = use_parent_emb
         self.label_sizes = label_sizes
+        self.level_heads = level_heads
 
 
         self.embedding = nn.Embedding(
@@ -249,7 +258,8 @@ class AttentiveHierarchicalClassifier(nn.Module):
                                num_layers=n_layers, bidirectional=True, batch_first=True)
 
         self.attention = DocumentLevelSelfAttention(embedding_dim, da, n_heads[-1],
-                            embedding_dim * 2, cat_emb=cat_emb_dim, use_rnn=self.use_rnn)
+                            embedding_dim * 2, cat_emb=cat_emb_dim, use_rnn=self.use_rnn,
+                            batched=batched_attention)
 
         linear_inp = n_heads[-1] * embedding_dim
         if use_rnn:
@@ -269,7 +279,9 @@ class AttentiveHierarchicalClassifier(nn.Module):
         self.linear_next = get_mlp(linear_inp, linear_outp, num_layers=hidden_layers, dropout=hidden_dropout)
 
 
-        if self.multi_class:
+        if self.level_heads:
+            self.level_classifier = LevelClassifier(classifier_inp, label_sizes, dropout=hidden_dropout)
+        elif self.multi_class:
             # TODO: need to correct for proper classes in decoder mode
             for i in range(levels):
                 setattr(self, 'classifier_l{}'.format(i+1),
@@ -367,36 +379,85 @@ class AttentiveHierarchicalClassifier(nn.Module):
 
         parent_emb = None
         if self.use_parent_emb:
-            ## create a parent class embedding layer
-            parent_emb = torch.zeros((inp_cat.size(0), sum(self.label_sizes[:-1])))
-            for row, inp in enumerate(inp_cat.data.cpu().numpy()):
-                parent_emb[row, inp - 1] = 1
-            parent_emb = parent_emb.to(device)
+            parent_emb = self.parent_embedding(inp_cat)
 
         if self.use_projection:
             proj_prev_emb = self.projection(prev_emb).unsqueeze(1)
         else:
             proj_prev_emb = cat_emb
 
-        doc_emb, attn = self.attention(encoder_outputs, encoder_lens,
-                                       cat_emb.size(0), proj_prev_emb,prev_attn=prev_attn)
+        with profiler.timer('level{}/attention'.format(level)):
+            doc_emb, attn = self.attention(encoder_outputs, encoder_lens,
+                                           cat_emb.size(0), proj_prev_emb,prev_attn=prev_attn)
 
-        doc_emb = doc_emb.view(doc_emb.size(0), -1)
+        with profiler.timer('level{}/mlp'.format(level)):
+            doc_emb = doc_emb.view(doc_emb.size(0), -1)
 
-        hidden_rep = self.dropout(self.linear_next(doc_emb))
-        inter_rep = hidden_rep
-        if self.use_parent_emb:
-            inter_rep = torch.cat((inter_rep, parent_emb),1)
-        if use_prev_emb:
-            inter_rep = torch.cat((prev_emb, inter_rep), 1)
+            hidden_rep = self.dropout(self.linear_next(doc_emb))
+            inter_rep = hidden_rep
+            if self.use_parent_emb:
+                inter_rep = torch.cat((inter_rep, parent_emb),1)
+            if use_prev_emb:
+                inter_rep = torch.cat((prev_emb, inter_rep), 1)
 
-        if self.multi_class:
-            logits = self.classifiers[level](inter_rep)
-        else:
-            logits = self.classifier_lall(inter_rep)
+            if self.level_heads:
+                logits = self.level_classifier(inter_rep, level)
+            elif self.multi_class:
+                logits = self.classifiers[level](inter_rep)
+            else:
+                logits = self.classifier_lall(inter_rep)
 
         return logits, attn, hidden_rep.view(prev_emb.size())
 
+    def parent_embedding(self, inp_cat):
+        ## create a parent class embedding layer
+        parent_emb = torch.zeros((inp_cat.size(0), sum(self.label_sizes[:-1])))
+        for row, inp in enumerate(inp_cat.data.cpu().numpy()):
+            parent_emb[row, inp - 1] = 1
+        return parent_emb.to(device)
+
+    def can_forward_levels(self, use_prev_emb=False):
+        """
+        All the levels can only be run in one pass (forward_levels) when no level depends on
+        the hidden_rep of the previous level, which is the case with
+            - use_projection : the attention query of a level is the projection of the previous hidden_rep
+            - use_prev_emb : the previous hidden_rep is concatenated to the classifier input
+        These need the sequential path, one forward per level.
+        """
+        return not self.use_projection and not use_prev_emb
+
+    def forward_levels(self, encoder_outputs, encoder_lens, inp_cats):
+        """
+        Same as forward for all the levels at once, given the input category of every level
+        (teacher forcing). The attention is run for the queries of all the levels in one batched
+        call, the classifier heads as one grouped matmul with level_heads.
+        Only valid if can_forward_levels
+        :param inp_cats: levels x batch, input category of each level
+        :return: logits (levels x batch x label_size), attentions (levels x batch x r x n),
+            hidden_rep (levels x batch x mlp_hidden_dim)
+        """
+        levels = inp_cats.size(0)
+        cat_emb = self.category_embedding(inp_cats).unsqueeze(2) # levels x batch x 1 x cat_emb_dim
+
+        with profiler.timer('levels/attention'):
+            doc_emb, attn = self.attention.multi_query_forward(encoder_outputs, encoder_lens, cat_emb)
+
+        with profiler.timer('levels/mlp'):
+            hidden_rep = self.dropout(self.linear_next(doc_emb))
+            inter_rep = hidden_rep
+            if self.use_parent_emb:
+                parent_emb = torch.stack([self.parent_embedding(inp_cat) for inp_cat in inp_cats])
+                inter_rep = torch.cat((inter_rep, parent_emb), 2)
+
+            if self.level_heads:
+                logits = self.level_classifier.forward_all(inter_rep)
+            elif self.multi_class:
+                logits = torch.stack([self.classifiers[level](inter_rep[level]) for level in range(levels)])
+            else:
+                logits = self.classifier_lall(inter_rep)
+
+        return logits, attn, hidden_rep
+
 
 
 class PooledHierarchicalClassifier(nn.Module):
@@ -589,38 +650,40 @@ class PooledHierarchicalClassifier(nn.Module):
                 parent_emb[row, inp-1] = 1
             parent_emb = parent_emb.to(device)
 
-        if self.attention_type == 'maxpool':
-            # Maxpool
-            doc_emb = torch.max(encoder_outputs, 1)[0]
-            # or mean pool
-            # doc_emb = torch.mean(encoder_outputs, 1).squeeze()
-            attn = None
-        elif self.attention_type == 'meanpool':
-            doc_emb = torch.mean(encoder_outputs, 1).squeeze()
-        elif self.attention_type == 'concat':
-            #pdb.set_trace()
-            maxp = torch.max(encoder_outputs, 1)[0]
-            meanp = torch.mean(encoder_outputs, 1)
-            doc_emb = torch.cat((maxp, meanp),1)
-        else:
-            raise NotImplementedError("attention type not implemented")
+        with profiler.timer('level{}/pooling'.format(level)):
+            if self.attention_type == 'maxpool':
+                # Maxpool
+                doc_emb = torch.max(encoder_outputs, 1)[0]
+                # or mean pool
+                # doc_emb = torch.mean(encoder_outputs, 1).squeeze()
+                attn = None
+            elif self.attention_type == 'meanpool':
+                doc_emb = torch.mean(encoder_outputs, 1).squeeze()
+            elif self.attention_type == 'concat':
+                #pdb.set_trace()
+                maxp = torch.max(encoder_outputs, 1)[0]
+                meanp = torch.mean(encoder_outputs, 1)
+                doc_emb = torch.cat((maxp, meanp),1)
+            else:
+                raise NotImplementedError("attention type not implemented")
 
         #pdb.set_trace()
         #print(doc_emb.size())
-        doc_emb = doc_emb.view(doc_emb.size(0), -1)
-        hidden_rep = self.linear(doc_emb)
-        inter_rep = hidden_rep
-        if self.use_parent_emb:
-            inter_rep = torch.cat((inter_rep, parent_emb),1)
-        if use_prev_emb:
-            inter_rep = torch.cat((prev_emb, inter_rep), 1)
-        if self.use_cat_emb:
-            inter_rep = torch.cat((cat_emb.squeeze(1), inter_rep), 1)
-
-        if self.multi_class:
-            logits = self.classifiers[level](self.relu(inter_rep))
-        else:
-            logits = self.classifier_lall(self.relu(inter_rep))
+        with profiler.timer('level{}/mlp'.format(level)):
+            doc_emb = doc_emb.view(doc_emb.size(0), -1)
+            hidden_rep = self.linear(doc_emb)
+            inter_rep = hidden_rep
+            if self.use_parent_emb:
+                inter_rep = torch.cat((inter_rep, parent_emb),1)
+            if use_prev_emb:
+                inter_rep = torch.cat((prev_emb, inter_rep), 1)
+            if self.use_cat_emb:
+                inter_rep = torch.cat((cat_emb.squeeze(1), inter_rep), 1)
+
+            if self.multi_class:
+                logits = self.classifiers[level](self.relu(inter_rep))
+            else:
+                logits = self.classifier_lall(self.relu(inter_rep))
 
         return logits, None, hidden_rep.view(prev_emb.size())
 
@@ -650,6 +713,8 @@ class Trainer():
                  max_words=0,
                  detach_encoder=False,
                  teacher_forcing=True,
+                 fast_train=False,
+                 parallel_levels=False,
                  **kwargs
                  ):
         self.model = model
@@ -672,24 +737,79 @@ class Trainer():
         self.n_heads = n_heads
         self.detach_encoder = detach_encoder
         self.teacher_forcing = teacher_forcing
+        self.fast_train = fast_train
+        self.parallel_levels = parallel_levels
+        if getattr(model, 'level_heads', False) and not self.renormalize:
+            # per level heads have no logits for the classes of the other levels
+            self.renormalize = 'level'
         if type(loss_weights) == torch.FloatTensor:
             self.loss_fn = nn.NLLLoss(weight=loss_weights)
         else:
             self.loss_fn = nn.NLLLoss()
+        self.level_mask, self.child_mask = self.build_taxonomy_masks()
+        self.category_mask = self.child_mask if self.renormalize == 'category' else None
+
+    def build_taxonomy_masks(self):
+        """
+        Build the renormalization masks once, on device.
+        level_mask : levels x total_cats, row l is 1 for every class not in level l
+        child_mask : parent x total_cats, row p is 1 for every class which is not a child of p
+            (parents without children in the taxonomy mask everything, as before)
+        :return: level_mask, child_mask (None if there is no taxonomy)
+        """
+        total = sum(self.label_sizes) + 1
+        level_mask = torch.ones(len(self.label_sizes), total, dtype=torch.bool)
+        ct = 1
+        for lv, lbs in enumerate(self.label_sizes):
+            level_mask[lv, ct:ct + lbs] = 0
+            ct += lbs
+        child_mask = None
+        if self.taxonomy:
+            child_mask = torch.ones(total, total, dtype=torch.bool)
+            for parent, child_classes in self.taxonomy.items():
+                child_mask[parent, list(child_classes)] = 0
+            child_mask = child_mask.to(device)
+        return level_mask.to(device), child_mask
+
+    def check_categories(self, categories):
+        """
+        Check once that all the category ids of a dataset fit in the category embedding,
+        instead of checking every batch (fast_train)
+        :param categories: num_docs x (levels + 1) decoder labels
+        """
+        if np.max(categories) >= self.total_cats:
+            raise RuntimeError("category ID outside of embedding")
+
+    def can_decode_parallel(self):
+        """
+        With teacher forcing, the levels are decoded in one pass if parallel_levels is set
+        and the model supports it (see AttentiveHierarchicalClassifier.can_forward_levels).
+        detach_encoder also needs the sequential path, as only the levels > 0 are detached.
+        """
+        return self.parallel_levels and not self.detach_encoder and \
+               hasattr(self.model, 'forward_levels') and self.model.can_forward_levels(self.use_prev_emb)
 
-    def batchNLLLoss(self, src, src_lengths, categories, mode='train', overall=True, tf_ratio=1):
+    def batchNLLLoss(self, src, src_lengths, categories, mode='train', overall=True, tf_ratio=1,
+                     encoded=None):
         """
         Calculate the negative log likelihood loss while predicting the categories
         :param src: documents to be classified
         :param src_lengths: length of the docs
         :param categories: hierarchical categories
+        :param encoded: (encoder_outputs, encoder_lens) from model.encode, to reuse one encoder pass
         :return:
+        With fast_train, training batches do not sync with the host: the accuracies are returned
+        as device tensors, the other outputs (attentions, predictions, ...) are empty, and the
+        category ids are not checked (see check_categories)
         """
 
         loss = 0
         log_loss = 0
         accs = []
-        encoder_outputs, encoder_lens = self.model.encode(src, src_lengths)
+        if encoded is None:
+            with profiler.timer('encode'):
+                encoded = self.model.encode(src, src_lengths)
+        encoder_outputs, encoder_lens = encoded
         hidden_rep = self.model.init_hidden(src.size(0))
         cat_len = categories.size(1) - 1
         # assert cat_len == max_categories
@@ -703,11 +823,16 @@ class Trainer():
         correct_confs = []
         incorrect_confs = []
         levels = len(self.label_sizes)
+        fast = self.fast_train and mode == 'train'
 
         #pdb.set_trace()
-        prev_attns = [torch.ones(
-            self.n_heads[-1], encoder_lens[b]).to(device)
-                      for b in range(encoder_outputs.size(0))]
+        if fast:
+            # unused by the models, not worth one host to device copy per document
+            prev_attns = False
+        else:
+            prev_attns = [torch.ones(
+                self.n_heads[-1], encoder_lens[b]).to(device)
+                          for b in range(encoder_outputs.size(0))]
 
         # if overall is set to true (by default)
         # if mode is train, then either train with teacher forcing or not
@@ -727,6 +852,11 @@ class Trainer():
             teacher_forcing = True if (random.random() < tf_ratio) else False
 
 
+        # with teacher forcing, the levels can be decoded in one pass
+        parallel = teacher_forcing and self.can_decode_parallel()
+        if parallel:
+            level_outputs = self.decode_levels(encoder_outputs, encoder_lens, categories[:, :levels].t())
+
         # training or inference
         for i in range(levels):
             # detach encoder
@@ -738,33 +868,17 @@ class Trainer():
             else:
                 topv, topi = out.data.topk(1)
                 inp_cat = topi.squeeze(1)
-            if torch.max(inp_cat).data.cpu().numpy() > self.total_cats:
+            if not fast and torch.max(inp_cat).data.cpu().numpy() > self.total_cats:
                 print(inp_cat)
                 raise RuntimeError("category ID outside of embedding")
             # hidden_state = torch.cat((hidden_state, context_state), 2)
             #inp_cat = inp_cat.unsqueeze(1)
-            if self.use_attn_mask:
-                attn_mask = self.get_attn_padding_mask(inp_cat, src)
+            if parallel:
+                out, attn, log_sum = level_outputs[i]
             else:
-                attn_mask = None
-            out, attn, hidden_rep = self.model(encoder_outputs, encoder_lens,
-                                            inp_cat, i, prev_emb=hidden_rep,
-                                            use_prev_emb=self.use_prev_emb,
-                                            attn_mask=attn_mask,
-                                            prev_attn=prev_attns)
+                out, attn, hidden_rep, log_sum = self.decode_step(encoder_outputs, encoder_lens, inp_cat, i,
+                                                                  hidden_rep, prev_attns, src)
             prev_attns = attn
-            log_sum = torch.mean(torch.sum(out, dim=1))
-            if self.renormalize:
-                if self.renormalize == 'level':
-                    out, log_sum = self.mask_level(out,i)
-                elif self.renormalize == 'category':
-                    out, log_sum = self.mask_category(out,inp_cat)
-
-            temp = 1
-            if i > 0:
-                temp = self.temperature
-            out = self.temp_logsoftmax(out, temp)
-            prob = torch.exp(out)
             target_cat = categories[:, i+1]
             if self.attn_penalty_coeff > 0:
                 attn_penalty = self.calculate_attention_penalty(attn, batch_size=inp_cat.size(0))
@@ -775,11 +889,15 @@ class Trainer():
             log_loss += log_sum
             loss += self.loss_fn(out, target_cat) * self.loss_focus[i] + \
                     self.attn_penalty_coeff * attn_penalty
+            if fast:
+                accs.append((torch.max(out.detach(), 1)[1] == target_cat).float().mean())
+                continue
+            prob = torch.exp(out)
             #out = self.mask_renormalize(inp_cat, out)
             pred_logits, out_pred = torch.max(out.data, 1)
 
             correct_idx = (out_pred == target_cat.data)
-            incorrect_idx = 1 - correct_idx
+            incorrect_idx = ~correct_idx
             acc = correct_idx.float().mean().item()
             # check if atleast one of them is correct
             if correct_idx.any():
@@ -804,34 +922,192 @@ class Trainer():
 
         return (loss, log_loss), accs, attns, predictions, correct_labels, correct_confs, incorrect_confs, probs
 
+    def decode_step(self, encoder_outputs, encoder_lens, inp_cat, level, hidden_rep, prev_attns, src):
+        """
+        Run one level of the top-down decoder and renormalize its output
+        :param inp_cat: category of the previous level, batch
+        :param level: current level
+        :param hidden_rep: hidden representation of the previous level
+        :return: log probabilities (batch x classes), attention, hidden_rep, log_sum
+        """
+        if self.use_attn_mask:
+            attn_mask = self.get_attn_padding_mask(inp_cat, src)
+        else:
+            attn_mask = None
+        out, attn, hidden_rep = self.model(encoder_outputs, encoder_lens,
+                                        inp_cat, level, prev_emb=hidden_rep,
+                                        use_prev_emb=self.use_prev_emb,
+                                        attn_mask=attn_mask,
+                                        prev_attn=prev_attns)
+        out, log_sum = self.renormalize_step(out, inp_cat, level)
+        return out, attn, hidden_rep, log_sum
+
+    def decode_levels(self, encoder_outputs, encoder_lens, inp_cats):
+        """
+        Run all the levels of the decoder in one pass, given the input category of every level
+        (teacher forcing, see can_decode_parallel). Gives the same outputs as decode_step per level
+        :param inp_cats: levels x batch
+        :return: list over levels of (log probabilities, attention, log_sum)
+        """
+        outs, attns, _ = self.model.forward_levels(encoder_outputs, encoder_lens, inp_cats)
+        level_outputs = []
+        for level in range(inp_cats.size(0)):
+            out, log_sum = self.renormalize_step(outs[level], inp_cats[level], level)
+            level_outputs.append((out, attns[level], log_sum))
+        return level_outputs
+
+    def renormalize_step(self, out, inp_cat, level):
+        """
+        Mask the logits of one level and normalize them
+        :return: log probabilities (batch x classes), log_sum
+        """
+        with profiler.timer('level{}/masking'.format(level)):
+            # masking and normalization always run in fp32, also under autocast
+            out = out.float()
+            log_sum = torch.mean(torch.sum(out, dim=1))
+            if self.renormalize:
+                if self.renormalize == 'level':
+                    out, log_sum = self.mask_level(out,level)
+                elif self.renormalize == 'category':
+                    out, log_sum = self.mask_category(out,inp_cat)
+
+            temp = 1
+            if level > 0:
+                temp = self.temperature
+            out = self.temp_logsoftmax(out, temp)
+        return out, log_sum
+
+    def predict(self, src, src_lengths, return_attns=False, return_probs=False):
+        """
+        Greedy top-down prediction, without gold categories and without any loss or
+        accuracy bookkeeping. Predictions stay on device, attentions and probabilities
+        are only copied to the cpu when asked for.
+        :param src: documents to be classified
+        :param src_lengths: length of the docs
+        :param return_attns: also return the attentions per level, as numpy arrays
+        :param return_probs: also return the probabilities per level, as numpy arrays
+        :return: predictions (batch x levels), confidences (batch x levels), attns, probs
+        """
+        levels = len(self.label_sizes)
+        attns = []
+        probs = []
+        predictions = []
+        confidences = []
+        with torch.no_grad():
+            encoder_outputs, encoder_lens = self.model.encode(src, src_lengths)
+            hidden_rep = self.model.init_hidden(src.size(0))
+            # start with the go label
+            inp_cat = torch.zeros(src.size(0), dtype=torch.long, device=src.device)
+            prev_attns = False
+            for i in range(levels):
+                out, attn, hidden_rep, _ = self.decode_step(encoder_outputs, encoder_lens, inp_cat, i,
+                                                            hidden_rep, prev_attns, src)
+                prev_attns = attn
+                pred_logits, inp_cat = torch.max(out, 1)
+                predictions.append(inp_cat)
+                confidences.append(torch.exp(pred_logits))
+                if return_attns:
+                    attns.append(self.convert_cpu(attn))
+                if return_probs:
+                    probs.append(self.convert_cpu(torch.exp(out)))
+        return torch.stack(predictions, 1), torch.stack(confidences, 1), attns, probs
+
+    def beam_predict(self, src, src_lengths, beam_size=5):
+        """
+        Top-k top-down prediction. All the beams of the batch are kept as one
+        (batch * beam_size) tensor on device, and every level only extends a path
+        with the children of its last label in the taxonomy (with the labels of
+        the next level if there is no taxonomy).
+        When a document has less than beam_size valid paths (e.g. beam_size is larger than the
+        number of classes), the remaining paths have a score of -inf.
+        :param src: documents to be classified
+        :param src_lengths: length of the docs
+        :param beam_size: number of paths to keep per document
+        :return: paths (batch x beam_size x levels), scores (batch x beam_size) joint log probability
+            of each path, sorted best first, and confidences (batch x beam_size x levels) per level
+        """
+        if beam_size < 1:
+            raise ValueError("beam_size should be at least 1, got {}".format(beam_size))
+        levels = len(self.label_sizes)
+        batch_size = src.size(0)
+        with torch.no_grad():
+            doc_outputs, doc_lens = self.model.encode(src, src_lengths)
+            doc_src = src
+            encoder_outputs, encoder_lens = doc_outputs, doc_lens
+            hidden_rep = self.model.init_hidden(batch_size)
+            # start with the go label, a single beam per document
+            inp_cat = torch.zeros(batch_size, dtype=torch.long, device=src.device)
+            scores = torch.zeros(batch_size, 1, device=src.device)
+            paths = torch.zeros(batch_size, 1, 0, dtype=torch.long, device=src.device)
+            level_scores = torch.zeros(batch_size, 1, 0, device=src.device)
+            beams = 1
+            for i in range(levels):
+                out, _, hidden_rep, _ = self.decode_step(encoder_outputs, encoder_lens, inp_cat, i,
+                                                         hidden_rep, False, src)
+                if self.child_mask is not None:
+                    invalid = self.child_mask.index_select(0, inp_cat)
+                else:
+                    invalid = self.level_mask[i].unsqueeze(0)
+                out = out.float().masked_fill(invalid, -float('inf'))
+                num_cats = out.size(1)
+                cand = (scores.view(-1, 1) + out).view(batch_size, beams * num_cats)
+                k = min(beam_size, beams * num_cats)
+                scores, top = cand.topk(k, 1)
+                origin = top // num_cats
+                inp_cat = (top % num_cats).view(-1)
+                # row of the parent beam in the flat (batch * beams) tensors
+                parent_rows = (origin + torch.arange(batch_size, device=src.device).unsqueeze(1) * beams).view(-1)
+                step_scores = out.view(-1).index_select(0, parent_rows * num_cats + inp_cat)
+                paths = torch.cat((paths.view(batch_size * beams, -1).index_select(0, parent_rows),
+                                   inp_cat.unsqueeze(1)), 1).view(batch_size, k, -1)
+                level_scores = torch.cat((level_scores.view(batch_size * beams, -1).index_select(0, parent_rows),
+                                          step_scores.unsqueeze(1)), 1).view(batch_size, k, -1)
+                hidden_rep = hidden_rep.index_select(0, parent_rows)
+                if beams != k:
+                    # the beams of a document are contiguous rows, so its encoder outputs are
+                    # repeated k times (from the unexpanded ones, k can change at every level)
+                    encoder_outputs = doc_outputs.repeat_interleave(k, 0)
+                    encoder_lens = doc_lens.repeat_interleave(k, 0)
+                    src = doc_src.repeat_interleave(k, 0)
+                beams = k
+            if beams < beam_size:
+                # less paths than beam_size, pad with -inf scores
+                missing = beam_size - beams
+                paths = torch.cat((paths, paths.new_zeros(batch_size, missing, levels)), 1)
+                scores = torch.cat((scores, scores.new_full((batch_size, missing), -float('inf'))), 1)
+                level_scores = torch.cat((level_scores,
+                                          level_scores.new_full((batch_size, missing, levels), -float('inf'))), 1)
+        return paths, scores, torch.exp(level_scores)
+
+    def inferenceNLLLoss(self, src, src_lengths, categories):
+        """
+        Encode the documents once, and decode them both without teacher forcing (overall)
+        and with teacher forcing (exact) from the shared encoder outputs
+        :param src: documents to be classified
+        :param src_lengths: length of the docs
+        :param categories: hierarchical categories
+        :return: {'overall': batchNLLLoss outputs, 'exact': batchNLLLoss outputs}
+        """
+        encoded = self.model.encode(src, src_lengths)
+        outputs = {}
+        for mode in ['overall', 'exact']:
+            outputs[mode] = self.batchNLLLoss(src, src_lengths, categories, mode='infer',
+                                              overall=(mode == 'overall'), encoded=encoded)
+        return outputs
+
     def apply_softmax(self, xs, mask, dtype=torch.DoubleTensor):
-        return MaskedSoftmaxAndLogSoftmax(dtype)(xs, mask)
+        # keep the precision of dtype, also under autocast
+        with torch.autocast(device_type=xs.device.type, enabled=False):
+            return MaskedSoftmaxAndLogSoftmax(dtype)(xs.to(dtype.dtype), mask.to(dtype.dtype))
 
     def mask_level(self, logits, level=0):
         """
         Given level, mask out all the other level classes
-        :param parent_class_batch: parent class ID in batch, batch x 1
         :param logits: batch x classes
+        :param level: current level
         :return:
         """
-        mask = [0]*(sum(self.label_sizes) + 1) # 912
-        label_indices = {}
-        ct = 1
-        for lv,lbs in enumerate(self.label_sizes):
-            label_indices[lv] = []
-            for lb in range(lbs):
-                label_indices[lv].append(ct)
-                ct +=1
-        for indc in label_indices[level]:
-            mask[indc] = 1
-        row_mask = [mask for i in range(logits.size(0))]
-        #pdb.set_trace()
-        #
-        #print(mask)
-        #row_mask = Variable(torch.ByteTensor(row_mask).cuda()).double()
-        mask = torch.ByteTensor(mask).to(device)
-        mask = mask ^ 1
-        #probs, logits = self.apply_softmax(logits.double(), row_mask)
+        mask = self.level_mask[level].unsqueeze(0)
         logits.data.masked_fill_(mask, 0)
         log_sum = torch.mean(torch.sum(logits, dim=1))
         logits.data.masked_fill_(mask, -float('inf'))
@@ -840,30 +1116,12 @@ class Trainer():
     def mask_category(self, logits, parent_class_batch, loss_weights=None):
         """
         Given a parent class, logits and taxonomy, mask the classes which are not in child
-        :param logits:
-        :param level:
+        :param logits: batch x classes
+        :param parent_class_batch: parent class ID in batch, batch
         :return:
         """
-        mask = torch.ones(logits.size())
-        parent_class_batch = parent_class_batch.data.cpu().numpy()
-        for batch_id, parent_class in enumerate(parent_class_batch):
-            if parent_class in self.taxonomy:
-                child_classes = self.taxonomy[parent_class]
-                for cc in child_classes:
-                    mask[batch_id][cc] = 0
-        #pdb.set_trace()
-        #mask = mask.byte() ^ 1
-        #mask = Variable(mask.float()).detach()
-        #mask = mask.cuda()
-        #probs = torch.exp(logits)
-        #masked_probs = probs * mask
-        # renormalize
-        #_sums = masked_probs.sum(-1, keepdim=True)
-        #probs = masked_probs.div(_sums)
-        #logits = torch.log(probs)
-        mask = mask.byte().to(device)
+        mask = self.category_mask.index_select(0, parent_class_batch.view(-1))
         logits.data.masked_fill_(mask, 0)
-        # pdb.set_trace()
         log_sum = torch.mean(torch.sum(logits, dim=1))
         logits.data.masked_fill_(mask, -float('inf'))
         return logits, log_sum
@@ -910,10 +1168,13 @@ class Trainer():
         return self.label2id['l{}_{}'.format(label, level)]
 
     def convert_cpu(self, attn):
+        if attn is None:
+            # pooled models have no attention
+            return None
         if type(attn) == list:
-            attn = [a.data.cpu().numpy() for a in attn]
+            attn = [a.data.float().cpu().numpy() for a in attn]
         else:
-            attn = attn.data.cpu().numpy()
+            attn = attn.data.float().cpu().numpy()
         return attn
 
 
@@ -90,8 +90,10 @@ class DocumentLevelSelfAttention(nn.Module):
     :param da: hidden dim of S1
     :r :number of hops
     :mlp_nhid: output of mlp dimension
+    :batched: if True, attend over the padded batch with a length mask instead of per document
     """
-    def __init__(self, nhid, da, r, mlp_nhid, cat_emb=0, batch_size=0, seq_len=0, cuda=True, use_rnn=True):
+    def __init__(self, nhid, da, r, mlp_nhid, cat_emb=0, batch_size=0, seq_len=0, cuda=True, use_rnn=True,
+                 batched=False):
         super(DocumentLevelSelfAttention, self).__init__()
         self.mult_factor = 1
         if use_rnn:
@@ -104,6 +106,7 @@ class DocumentLevelSelfAttention(nn.Module):
         self.r = r
         self.nhid = nhid
         self.cuda = cuda
+        self.batched = batched
 
     def init_weights(self):
         initrange = 0.1
@@ -134,6 +137,8 @@ class DocumentLevelSelfAttention(nn.Module):
         Changes required,
             W_{s_1} = d_a x 3 D
         """
+        if self.batched:
+            return self.batched_forward(encoder_outputs, encoder_lengths, cat_emb, temp=temp)
         BM = torch.zeros(batch_size, self.r * self.nhid * self.mult_factor).to(device)
         weights = []
         HV = encoder_outputs
@@ -155,6 +160,124 @@ class DocumentLevelSelfAttention(nn.Module):
 
         return BM, weights
 
+    def batched_forward(self, encoder_outputs, encoder_lengths, cat_emb, temp=1):
+        """
+        Same computation as `forward`, but over the whole padded batch at once.
+        Padded positions are masked with -inf before the softmax so that each
+        document only attends over its own length.
+        :param encoder_outputs: B x n x 2D = H
+        :param encoder_lengths: B (list or tensor)
+        :param cat_emb: B x 1 x D, V
+        :param temp: temperature for softmax
+        :return: BM : B x (r * 2D), A : B x r x n (zero on padded positions)
+        """
+        batch_size, max_len, _ = encoder_outputs.size()
+        HV = torch.cat([encoder_outputs, cat_emb.expand(-1, max_len, -1)], 2) # B x n x 3D
+        s2 = self.S2(F.tanh(self.S1(HV))) # B x n x r
+        s2 = s2.transpose(1, 2) / temp # B x r x n
+        lengths = torch.as_tensor(encoder_lengths, device=encoder_outputs.device)
+        pad_mask = torch.arange(max_len, device=encoder_outputs.device).unsqueeze(0) >= lengths.unsqueeze(1)
+        s2 = s2.masked_fill(pad_mask.unsqueeze(1), -float('inf'))
+        A = F.softmax(s2, dim=2) # B x r x n
+        M = torch.bmm(A, encoder_outputs) # (B x r x n) * (B x n x 2D) = B x r x 2D
+        BM = M.view(batch_size, -1)
+        return BM, A
+
+    def multi_query_forward(self, encoder_outputs, encoder_lengths, cat_embs, temp=1):
+        """
+        Same computation as `batched_forward`, for several queries per document at once
+        (e.g. the categories of all the levels). S1 is linear, so S1(H (+) V) = S1_H(H) + S1_V(V):
+        the encoder outputs are projected once and shared by all the queries.
+        :param encoder_outputs: B x n x 2D = H
+        :param encoder_lengths: B (list or tensor)
+        :param cat_embs: Q x B x 1 x D, Q queries V per document
+        :param temp: temperature for softmax
+        :return: BM : Q x B x (r * 2D), A : Q x B x r x n (zero on padded positions)
+        """
+        queries, batch_size = cat_embs.size(0), cat_embs.size(1)
+        max_len = encoder_outputs.size(1)
+        w_h, w_v = self.S1.weight.split([encoder_outputs.size(2), cat_embs.size(3)], 1)
+        s1 = F.linear(encoder_outputs, w_h).unsqueeze(0) + F.linear(cat_embs, w_v) # Q x B x n x da
+        s2 = self.S2(F.tanh(s1)) # Q x B x n x r
+        s2 = s2.transpose(2, 3) / temp # Q x B x r x n
+        lengths = torch.as_tensor(encoder_lengths, device=encoder_outputs.device)
+        pad_mask = torch.arange(max_len, device=encoder_outputs.device).unsqueeze(0) >= lengths.unsqueeze(1)
+        s2 = s2.masked_fill(pad_mask.unsqueeze(1), -float('inf'))
+        A = F.softmax(s2, dim=3) # Q x B x r x n
+        M = torch.matmul(A, encoder_outputs.unsqueeze(0)) # Q x B x r x 2D
+        BM = M.view(queries, batch_size, -1)
+        return BM, A
+
+class LevelClassifier(nn.Module):
+    """
+    Classifier heads of all the levels, where each head only projects onto the classes of its level.
+    Each head has the layers of get_mlp (num_layers - 1 hidden layers with relu and dropout,
+    then the output layer). The weights of the levels are stacked (the output layer is padded
+    to the largest level), so that the heads of all the levels can also run as one grouped
+    matmul with forward_all. forward_all needs the inputs of all the levels at once, so it is
+    only used when the teacher forced levels are decoded in one pass (forward_levels),
+    the step by step decoding runs one head per step with forward.
+    Logits are returned in the global label id space (go label, then the classes of each level),
+    with 0 for the classes of the other levels.
+    :param input_dim: input dimension of every head
+    :param label_sizes: number of classes per level
+    """
+    def __init__(self, input_dim, label_sizes, num_layers=2, dropout=0):
+        super(LevelClassifier, self).__init__()
+        assert num_layers > 0
+        self.input_dim = input_dim
+        self.label_sizes = list(label_sizes)
+        self.levels = len(self.label_sizes)
+        self.label_size = sum(self.label_sizes) + 1
+        self.offsets = [1 + sum(self.label_sizes[:level]) for level in range(self.levels)]
+        max_size = max(self.label_sizes)
+        self.hidden_weights = nn.ParameterList([nn.Parameter(torch.FloatTensor(self.levels, input_dim, input_dim))
+                                                for _ in range(num_layers - 1)])
+        self.hidden_biases = nn.ParameterList([nn.Parameter(torch.FloatTensor(self.levels, 1, input_dim))
+                                               for _ in range(num_layers - 1)])
+        self.out_weight = nn.Parameter(torch.FloatTensor(self.levels, input_dim, max_size))
+        self.out_bias = nn.Parameter(torch.FloatTensor(self.levels, 1, max_size))
+        self.dropout = nn.Dropout(dropout)
+        self.init_weights()
+
+    def init_weights(self):
+        # default initialization of nn.Linear
+        bound = 1 / math.sqrt(self.input_dim)
+        for param in self.parameters():
+            param.data.uniform_(-bound, bound)
+
+    def to_global(self, logits, level):
+        """
+        :param logits: ... x label_sizes[level]
+        :return: ... x label_size, the logits of the level at its label ids
+        """
+        offset = self.offsets[level]
+        return F.pad(logits, (offset, self.label_size - offset - self.label_sizes[level]))
+
+    def forward(self, x, level):
+        """
+        :param x: B x input_dim
+        :param level: level of the head
+        :return: B x label_size
+        """
+        for weight, bias in zip(self.hidden_weights, self.hidden_biases):
+            x = self.dropout(F.relu(torch.addmm(bias[level], x, weight[level])))
+        size = self.label_sizes[level]
+        logits = torch.addmm(self.out_bias[level, :, :size], x, self.out_weight[level, :, :size])
+        return self.to_global(logits, level)
+
+    def forward_all(self, xs):
+        """
+        Run the heads of all the levels as grouped matmuls
+        :param xs: levels x B x input_dim, input of each level
+        :return: levels x B x label_size
+        """
+        for weight, bias in zip(self.hidden_weights, self.hidden_biases):
+            xs = self.dropout(F.relu(torch.baddbmm(bias, xs, weight)))
+        logits = torch.baddbmm(self.out_bias, xs, self.out_weight) # levels x B x max size
+        return torch.stack([self.to_global(logits[level, :, :size], level)
+                            for level, size in enumerate(self.label_sizes)])
+
 class BahdanauAttn(nn.Module):
     def __init__(self, method, hidden_size, concat_size=None):
         super(BahdanauAttn, self).__init__()
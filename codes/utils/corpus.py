@@ -0,0 +1,142 @@
+## Binary, memory-mapped storage for the preprocessed corpus
+## Layout of a corpus directory:
+##   tokens.npy          : int32, all token ids of all documents, concatenated
+##   offsets.npy         : int64, num_docs + 1, document i is tokens[offsets[i]:offsets[i+1]]
+##   labels.npy          : int64, num_docs x levels, raw per level labels
+##   decoder_labels.npy  : int64, num_docs x (levels + 1), decoder labels with the go label
+##   meta.pkl            : vocab, taxonomy, label maps and splits (written last)
+
+import os
+import pickle as pkl
+import numpy as np
+
+TOKENS_FILE = 'tokens.npy'
+OFFSETS_FILE = 'offsets.npy'
+LABELS_FILE = 'labels.npy'
+DECODER_LABELS_FILE = 'decoder_labels.npy'
+META_FILE = 'meta.pkl'
+
+TOKEN_DTYPE = np.int32
+LABEL_DTYPE = np.int64
+WRITE_CHUNK = 1 << 24 # tokens copied at once when writing
+
+
+class EncodedCorpus(object):
+    """
+    Read only view over a flat token id array and its offsets.
+    Indexing returns the token ids of one document as a numpy array,
+    without copying when the arrays are memory-mapped.
+    """
+    def __init__(self, tokens, offsets):
+        self.tokens = tokens
+        self.offsets = offsets
+
+    def __getitem__(self, index):
+        return self.tokens[self.offsets[index]:self.offsets[index + 1]]
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def lengths(self):
+        """
+        length of every document
+        :return: int64 array, num_docs
+        """
+        return np.diff(self.offsets)
+
+    @classmethod
+    def from_documents(cls, documents, word2id, unk_id):
+        """
+        Encode a list of tokenized documents into a flat id array
+        :param documents: list of list of tokens
+        :param word2id: vocab
+        :param unk_id: id for out of vocab tokens
+        :return: EncodedCorpus
+        """
+        offsets = np.zeros(len(documents) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(doc) for doc in documents])
+        tokens = np.empty(offsets[-1], dtype=TOKEN_DTYPE)
+        for i, doc in enumerate(documents):
+            tokens[offsets[i]:offsets[i + 1]] = [word2id.get(word, unk_id) for word in doc]
+        return cls(tokens, offsets)
+
+
+class RemappedTokens(object):
+    """
+    Token ids written to a raw int32 file with provisional ids, mapped to their
+    final ids on access. Used when streaming, as the final vocab ids are only
+    known once the whole corpus has been counted.
+    """
+    def __init__(self, raw_path, remap):
+        self.raw_path = raw_path
+        self.remap = remap
+        if os.path.getsize(raw_path) > 0:
+            self.raw = np.memmap(raw_path, dtype=TOKEN_DTYPE, mode='r')
+        else:
+            self.raw = np.zeros(0, dtype=TOKEN_DTYPE)
+
+    def __getitem__(self, index):
+        return self.remap[self.raw[index]]
+
+    def __len__(self):
+        return len(self.raw)
+
+    def remove(self):
+        """
+        delete the raw file
+        """
+        self.raw = None
+        os.remove(self.raw_path)
+
+
+def corpus_exists(corpus_dir):
+    return os.path.exists(os.path.join(corpus_dir, META_FILE))
+
+
+def write_corpus(corpus_dir, corpus, labels, decoder_labels, meta):
+    """
+    Write the corpus in the binary format. meta.pkl is written last so that
+    an interrupted write is never picked up as a complete corpus.
+    :param corpus_dir: directory to write into
+    :param corpus: EncodedCorpus
+    :param labels: num_docs x levels
+    :param decoder_labels: num_docs x (levels + 1)
+    :param meta: dictionary of small, picklable objects
+    :return:
+    """
+    if not os.path.exists(corpus_dir):
+        os.makedirs(corpus_dir)
+    meta_path = os.path.join(corpus_dir, META_FILE)
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    # copy the tokens chunk by chunk so that streamed corpora are never fully in memory
+    num_tokens = len(corpus.tokens)
+    tokens = np.lib.format.open_memmap(os.path.join(corpus_dir, TOKENS_FILE), mode='w+',
+                                       dtype=TOKEN_DTYPE, shape=(num_tokens,))
+    for start in range(0, num_tokens, WRITE_CHUNK):
+        tokens[start:start + WRITE_CHUNK] = corpus.tokens[start:start + WRITE_CHUNK]
+    tokens.flush()
+    del tokens
+    np.save(os.path.join(corpus_dir, OFFSETS_FILE), np.asarray(corpus.offsets, dtype=np.int64))
+    np.save(os.path.join(corpus_dir, LABELS_FILE), np.asarray(labels, dtype=LABEL_DTYPE))
+    np.save(os.path.join(corpus_dir, DECODER_LABELS_FILE), np.asarray(decoder_labels, dtype=LABEL_DTYPE))
+    tmp_path = meta_path + '.tmp'
+    with open(tmp_path, 'wb') as fp:
+        pkl.dump(meta, fp)
+    os.replace(tmp_path, meta_path)
+
+
+def read_corpus(corpus_dir, mmap_mode='r'):
+    """
+    Read the corpus, memory-mapping the arrays
+    :param corpus_dir: directory written by write_corpus
+    :param mmap_mode: numpy mmap mode, None to read into memory
+    :return: corpus, labels, decoder_labels, meta
+    """
+    tokens = np.load(os.path.join(corpus_dir, TOKENS_FILE), mmap_mode=mmap_mode)
+    offsets = np.load(os.path.join(corpus_dir, OFFSETS_FILE), mmap_mode=mmap_mode)
+    labels = np.load(os.path.join(corpus_dir, LABELS_FILE), mmap_mode=mmap_mode)
+    decoder_labels = np.load(os.path.join(corpus_dir, DECODER_LABELS_FILE), mmap_mode=mmap_mode)
+    with open(os.path.join(corpus_dir, META_FILE), 'rb') as fp:
+        meta = pkl.load(fp)
+    return EncodedCorpus(tokens, offsets), labels, decoder_labels, meta
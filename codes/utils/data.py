@@ -16,6 +16,7 @@ import pandas
 from codes.utils import constants
 from collections import Counter
 import re
+import multiprocessing
 import logging
 logging.basicConfig(
     level=logging.INFO,
@@ -23,6 +24,9 @@ logging.basicConfig(
 )
 from codes.utils.config import get_sample_config, get_config
 from codes.utils.batch import Batch
+from codes.utils import corpus as corpus_utils
+from codes.utils import embedding as embedding_utils
+from codes.utils import distributed
 import pdb
 import pickle as pkl
 
@@ -52,9 +56,17 @@ class Data_Utility(data.Dataset):
         self.data_type = config['data_type']
         self.data_loc = config['data_loc']
         self.batch_size = config['batch_size']
+        self.batch_sampler = config.get('batch_sampler', 'random') # random / bucket / tokens
+        self.bucket_size = config.get('bucket_size', 50) # batches per sorted chunk
+        self.max_batch_tokens = config.get('max_batch_tokens', 0) # padded tokens per batch in tokens mode
+        self.preprocess_workers = config.get('preprocess_workers', 1) # processes used to tokenize
+        self.csv_chunksize = config.get('csv_chunksize', 0) # if > 0, stream csv data in chunks of rows
+        self.seed = config.get('seed', 0) # shared by the processes to shard the training rows
         self.save_path_base = os.path.join(base_loc, 'data', self.data_path)
         self.save_loc = os.path.join(self.save_path_base,
                                      '{}_processed_{}.pkl'.format(self.data_type, self.tokenization))
+        self.corpus_loc = os.path.join(self.save_path_base,
+                                       '{}_processed_{}'.format(self.data_type, self.tokenization))
 
         if not os.path.exists(self.save_path_base):
             os.makedirs(self.save_path_base)
@@ -82,19 +94,13 @@ class Data_Utility(data.Dataset):
         if self.data_type == 'WOS':
             ## Web of science data
             logging.info("Reading WOS data")
-            i = 0
             logging.info("Reading file X.txt")
             with open(os.path.join(data_loc, 'X.txt')) as fp:
-                for line in fp:
-                    text = self.tokenize(line.strip())
-                    items.update(text)
-                    ## prune docs by max words
-                    if self.max_word_doc > 0 and len(text) > self.max_word_doc:
-                        text = text[:self.max_word_doc]
-                    text_data.append(text)
-                    data_indexes.append(i)
-                    i+=1
-            logging.info("Read {} rows".format(i))
+                lines = [line.strip() for line in fp]
+            ## vocab is counted before pruning docs by max words
+            text_data, items = self.tokenize_documents(lines, count_pruned=False)
+            data_indexes = list(range(len(text_data)))
+            logging.info("Read {} rows".format(len(text_data)))
             dict_m['word2id'], dict_m['id2word'] = self.assign_wordids(items, self.special_tokens)
             ## add the level1, level2 and level3 in per array
 
@@ -125,40 +131,19 @@ class Data_Utility(data.Dataset):
         elif self.data_type == 'WIKI':
             logging.info("Reading WIKI data")
             full_data_csv_path = os.path.join(data_loc,'wiki_data.csv')
-            df = pandas.read_csv(full_data_csv_path)
             y_class2id = {'l1':{},'l2':{},'l3':{}}
-            ct_dict = {'l1':0,'l2':0,'l3':0}
-
-            def gen_class_id(row, level):
-                class_name = row[level]
-                ct = ct_dict[level]
-                if class_name not in y_class2id[level]:
-                    y_class2id[level][class_name] = ct
-                    ct_dict[level] += 1
-                return y_class2id[level][class_name]
-
-            for i,row in df.iterrows():
-                l_1 = gen_class_id(row,'l1')
-                l_2 = gen_class_id(row, 'l2')
-                l_3 = gen_class_id(row, 'l3')
-                text = row['text']
-                if not self.clean:
-                    text = text.lower()
-                if '<sent>' in text:
-                    # data has been sentence tokenized
-                    text = text.split('<sent>')
-                    text = [self.tokenize(str(t)) for t in text]
-                else:
-                    text = self.tokenize(str(text))
-                ## prune docs by max words
-                if self.max_word_doc > 0 and len(text) > self.max_word_doc:
-                    text = text[:self.max_word_doc]
-                ## remove rows which do not have anything
-                if len(text) == 0:
-                    continue
-                text_data.append(text)
-                items.update(text)
-                y_classes.append([l_1, l_2, l_3])
+            if self.csv_chunksize > 0:
+                text_data, y_classes, items = self.stream_wiki(full_data_csv_path, y_class2id)
+            else:
+                df = pandas.read_csv(full_data_csv_path)
+                texts, row_classes = self.read_wiki_rows(df, y_class2id)
+                docs, items = self.tokenize_documents(texts, count_pruned=True)
+                for text, classes in zip(docs, row_classes):
+                    ## remove rows which do not have anything
+                    if len(text) == 0:
+                        continue
+                    text_data.append(text)
+                    y_classes.append(classes)
             logging.info("Read {} rows".format(len(text_data)))
             data_indexes = list(range(len(text_data)))
 
@@ -246,12 +231,110 @@ class Data_Utility(data.Dataset):
             'dict_m' : dict_m,
             'data_m' : data_m
         }
-        save_path = os.path.join(self.save_path_base,
-                                        '{}_processed_{}.pkl'.format(self.data_type, self.tokenization))
-        pkl.dump(pd, open(save_path, 'wb'))
-        logging.info("Saved in {}".format(save_path))
+        self.save_corpus(pd)
         return pd
 
+    def save_corpus(self, processed_dict):
+        """
+        Encode the tokenized documents and write them in the binary corpus format
+        :param processed_dict: {'dict_m': ..., 'data_m': ...} as built by preprocess
+        :return:
+        """
+        dict_m = processed_dict['dict_m']
+        data_m = dict(processed_dict['data_m'])
+        word2id = dict_m['word2id']
+        encoded = data_m.pop('data')
+        if not isinstance(encoded, corpus_utils.EncodedCorpus):
+            logging.info("Encoding documents...")
+            encoded = corpus_utils.EncodedCorpus.from_documents(encoded, word2id,
+                                                                word2id[constants.UNK_WORD])
+        labels = data_m.pop('labels')
+        decoder_labels = data_m.pop('decoder_labels')
+        meta = {'dict_m': dict_m, 'data_m': data_m}
+        corpus_utils.write_corpus(self.corpus_loc, encoded, labels, decoder_labels, meta)
+        if isinstance(encoded.tokens, corpus_utils.RemappedTokens):
+            encoded.tokens.remove()
+        logging.info("Saved in {}".format(self.corpus_loc))
+
+    def read_wiki_rows(self, df, y_class2id):
+        """
+        Extract the raw texts and assign class ids for the rows of a WIKI dataframe.
+        Class ids are given per level in order of first appearance, y_class2id is updated in place.
+        Sentence tokenized texts (with <sent>) are split here, the documents stay flat token lists
+        :param df: dataframe with l1, l2, l3 and text columns
+        :param y_class2id: {'l1': {}, 'l2': {}, 'l3': {}}
+        :return: texts, row classes
+        """
+        def gen_class_id(class_name, level):
+            if class_name not in y_class2id[level]:
+                y_class2id[level][class_name] = len(y_class2id[level])
+            return y_class2id[level][class_name]
+
+        row_classes = []
+        texts = []
+        for l_1, l_2, l_3, text in zip(df['l1'], df['l2'], df['l3'], df['text']):
+            row_classes.append([gen_class_id(l_1, 'l1'),
+                                gen_class_id(l_2, 'l2'),
+                                gen_class_id(l_3, 'l3')])
+            text = str(text)
+            if not self.clean:
+                text = text.lower()
+            if '<sent>' in text:
+                # data has been sentence tokenized, keep the sentences apart but in one document
+                text = '\n'.join(text.split('<sent>'))
+            texts.append(text)
+        return texts, row_classes
+
+    def stream_wiki(self, csv_path, y_class2id):
+        """
+        Read the WIKI csv in chunks of csv_chunksize rows, so that memory is bounded by the
+        chunk size rather than the corpus size. Each chunk is tokenized and counted, and its
+        tokens are appended to a raw file with provisional ids (in order of first appearance).
+        Once the whole corpus is counted the provisional ids are mapped to the vocab ids,
+        which happens when the corpus is written.
+        :param csv_path: wiki_data.csv
+        :param y_class2id: {'l1': {}, 'l2': {}, 'l3': {}}, updated in place
+        :return: EncodedCorpus, row classes, Counter
+        """
+        raw_path = self.corpus_loc + '_tokens.tmp'
+        provisional = {}
+        lengths = []
+        y_classes = []
+        items = Counter()
+        pool = None
+        if self.preprocess_workers > 1:
+            pool = multiprocessing.Pool(self.preprocess_workers)
+        try:
+            with open(raw_path, 'wb') as fp:
+                for df in pandas.read_csv(csv_path, chunksize=self.csv_chunksize):
+                    texts, row_classes = self.read_wiki_rows(df, y_class2id)
+                    docs, chunk_items = self.tokenize_documents(texts, count_pruned=True, pool=pool)
+                    items.update(chunk_items)
+                    chunk_ids = []
+                    for text, classes in zip(docs, row_classes):
+                        ## remove rows which do not have anything
+                        if len(text) == 0:
+                            continue
+                        chunk_ids.extend(provisional.setdefault(word, len(provisional)) for word in text)
+                        lengths.append(len(text))
+                        y_classes.append(classes)
+                    np.asarray(chunk_ids, dtype=corpus_utils.TOKEN_DTYPE).tofile(fp)
+                    logging.info("Read {} rows".format(len(y_classes)))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        word2id, _ = self.assign_wordids(items, self.special_tokens)
+        remap = np.full(len(provisional), word2id[constants.UNK_WORD], dtype=corpus_utils.TOKEN_DTYPE)
+        for word, pid in provisional.items():
+            if word in word2id:
+                remap[pid] = word2id[word]
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(lengths)
+        tokens = corpus_utils.RemappedTokens(raw_path, remap)
+        return corpus_utils.EncodedCorpus(tokens, offsets), y_classes, items
+
     def get_level_labels(self, level=0):
         """
         return list of all labels in the particular level
@@ -274,12 +357,36 @@ class Data_Utility(data.Dataset):
         :param mode: word/char
         :return: splitted array
         """
-        if self.clean:
-            sent = text_cleaner(sent)
-        if self.tokenization == 'word':
-            return word_tokenize(sent)
-        if self.tokenization == 'char':
-            return sent.split()
+        return tokenize_text(sent, self.clean, self.tokenization)
+
+    def tokenize_documents(self, texts, count_pruned=True, pool=None):
+        """
+        Tokenize, prune and count a list of raw documents.
+        With preprocess_workers > 1 the list is split in contiguous shards which are
+        tokenized in a process pool. Shards are merged in order, so the documents and
+        the first-seen order of the Counter (hence the vocab ids) match the serial path.
+        :param texts: list of raw documents
+        :param count_pruned: if True count words after pruning docs by max words, else before
+        :param pool: process pool to reuse, if None one is created for this call
+        :return: list of token lists, Counter
+        """
+        args = (self.clean, self.tokenization, self.max_word_doc, count_pruned)
+        if self.preprocess_workers <= 1 or len(texts) < self.preprocess_workers:
+            return tokenize_shard(texts, *args)
+        shard_size = (len(texts) + self.preprocess_workers - 1) // self.preprocess_workers
+        shards = [(texts[i:i + shard_size],) + args for i in range(0, len(texts), shard_size)]
+        logging.info("Tokenizing {} shards with {} processes".format(len(shards), self.preprocess_workers))
+        if pool is None:
+            with multiprocessing.Pool(self.preprocess_workers) as pool:
+                results = pool.starmap(tokenize_shard, shards)
+        else:
+            results = pool.starmap(tokenize_shard, shards)
+        docs = []
+        items = Counter()
+        for shard_docs, shard_items in results:
+            docs.extend(shard_docs)
+            items.update(shard_items)
+        return docs, items
 
     def assign_wordids(self, words, special_tokens=None):
         """
@@ -307,12 +414,23 @@ class Data_Utility(data.Dataset):
 
     def load(self):
         ## Load previously preprocessed data, and add to the object
-        if not os.path.exists(self.save_loc):
-            logging.info("Preprocessing...")
-            processed_dict = self.preprocess()
-        else:
-            logging.info("Loading previously preprocessed data...")
-            processed_dict = pkl.load(open(self.save_loc, 'rb'))
+        ## the arrays of the binary corpus are memory-mapped, so they are shared
+        ## between the DataLoader workers instead of being copied into each of them
+        if not corpus_utils.corpus_exists(self.corpus_loc):
+            if os.path.exists(self.save_loc):
+                logging.info("Converting previously preprocessed pickle to binary corpus...")
+                self.save_corpus(pkl.load(open(self.save_loc, 'rb')))
+            else:
+                logging.info("Preprocessing...")
+                self.preprocess()
+        logging.info("Loading previously preprocessed data...")
+        encoded, labels, decoder_labels, meta = corpus_utils.read_corpus(self.corpus_loc)
+        processed_dict = meta
+        processed_dict['data_m'].update({
+            'data': encoded,
+            'labels': labels,
+            'decoder_labels': decoder_labels
+        })
         self.word2id = processed_dict['dict_m']['word2id']
         self.id2word = processed_dict['dict_m']['id2word']
         self.dyna_dict = processed_dict['dict_m']['dyna_dict']
@@ -331,7 +449,20 @@ class Data_Utility(data.Dataset):
         self.decoder_num_labels = processed_dict['data_m']['decoder_num_labels']
         self.train_indices = processed_dict['data_m']['train_indices']
         self.test_indices = processed_dict['data_m']['test_indices']
+        self.targets = self.get_targets()
 
+    def get_targets(self):
+        """
+        Build the target label rows once, for every document
+        :return: num_docs x (levels + 1) if decoder_ready, num_docs x 2 if a single level is chosen
+        """
+        if self.level != -1:
+            targets = np.zeros((len(self.labels), 2), dtype=np.int64)
+            targets[:, 1] = self.labels[:, self.level]
+            return targets
+        if self.decoder_ready:
+            return self.decoder_labels
+        return self.labels
 
 
     def split_indices(self):
@@ -364,13 +495,15 @@ class Data_Utility(data.Dataset):
         ##self.train_indices = shuffled[:num_train]
         ##self.test_indices = shuffled[num_train:]
 
-    def load_embedding(self,embedding_file='', embedding_saved='', embedding_dim=300, data_path=''):
+    def load_embedding(self,embedding_file='', embedding_saved='', embedding_dim=300, data_path='',
+                       use_cache=False):
         """
         Initialize the embedding from pre-trained vectors
         :param embedding_file: pre-trained vector file, eg glove.txt
         :param embedding_saved: file to save the embeddings
         :param embedding_dim: dimensions, eg 300
         :param data_path: data path
+        :param use_cache: keep a binary cache of the full pre-trained file, shared across data paths
         :return: embedding matrix
         """
 
@@ -387,72 +520,63 @@ class Data_Utility(data.Dataset):
             embeddings = torch.load(
                 open(emb_saved_full_path, 'rb'))
         else:
-            embeddings = torch.Tensor(len(word_dict), embedding_dim)
-            embeddings.normal_(0, 1)
-            word_count = 0
-
-            # Fill in embeddings
-            if not embedding_file:
-                raise RuntimeError(
-                    'Tried to load embeddings with no embedding file.')
-            num_lines = sum(1 for line in open(embedding_file))
-            pbar = tqdm(total=num_lines)
-            done_words = []
-            vec_word_dict = {}
-
-            with open(embedding_file, 'r') as f:
-                for line in f:
-                    parsed = line.rstrip().split(' ')
-                    if len(parsed) == 2:
-                        # first line, so skip
-                        pbar.update(1)
-                        continue
-                    assert (len(parsed) == embedding_dim + 1)
-                    w = parsed[0]
-                    if w in word_dict:
-                        vec = [float(i) for i in parsed[1:]]
-                        vec_word_dict[w] = vec
-                        vec = torch.Tensor(vec)
-                        embeddings[word_dict[w]].copy_(vec)
-                        word_count += 1
-                        done_words.append(w)
-                    pbar.update(1)
-            pbar.close()
-            print('Done words : {}'.format(len(done_words)))
+            embeddings = embedding_utils.load_pretrained(embedding_file, word_dict,
+                                                         embedding_dim=embedding_dim,
+                                                         use_cache=use_cache)
             # save the embeddings
             torch.save(embeddings, open(emb_saved_full_path, 'wb'))
 
         return embeddings
 
 
-    def get_dataloader(self, mode='train'):
+    def get_dataloader(self, mode='train', epoch=0):
         ## return torch.DataLoader instance
+        ## documents are already encoded, so only the row indices are passed on
+        ## with multiple processes, each one gets its own shard of the rows
         if mode == 'train':
-            rows = self.train_indices
+            rows = self.shard_rows(self.train_indices, epoch=epoch, shuffle=True)
         else:
-            rows = self.test_indices
-        data_rows = []
-        label_rows = []
-        for row_index in rows:
-
-            data = self.data[row_index]
-            data = [self.word2id[word] if word in self.word2id else self.word2id[constants.UNK_WORD]
-                    for word in data]
-            labels = self.labels[row_index]
-            if self.decoder_ready:
-                labels = self.decoder_labels[row_index]
-            if self.level != -1:
-                labels = self.labels[row_index]
-                labels = [0, labels[self.level]]
-            data_rows.append(data)
-            label_rows.append(labels)
-
-        return torch.utils.data.DataLoader(TextDataLoader(data_rows, label_rows),
+            rows = self.shard_rows(self.test_indices)
+
+        dataset = TextDataLoader(self.data, self.targets, rows=rows)
+        if self.batch_sampler in ['bucket', 'tokens']:
+            lengths = self.data.lengths()[np.asarray(rows, dtype=np.int64)]
+            if self.batch_sampler == 'bucket':
+                sampler = BucketBatchSampler(lengths, self.batch_size, self.bucket_size)
+            else:
+                sampler = TokenBudgetBatchSampler(lengths, self.max_batch_tokens,
+                                                  self.batch_size, self.bucket_size)
+            return torch.utils.data.DataLoader(dataset,
+                batch_sampler=sampler,
+                collate_fn=collate_fn,
+                num_workers=4)
+        elif self.batch_sampler != 'random':
+            raise NotImplementedError("batch_sampler {} not implemented".format(self.batch_sampler))
+
+        return torch.utils.data.DataLoader(dataset,
             batch_size=self.batch_size,
             shuffle=True,
             collate_fn=collate_fn,
             num_workers=4)
 
+    def shard_rows(self, rows, epoch=0, shuffle=False):
+        """
+        Rows of the current process. Training rows are shuffled with a permutation
+        shared by all the processes (seeded by seed and epoch) before being split,
+        so that every epoch each process sees a different part of the data.
+        :param rows: row indices
+        :param epoch: current epoch
+        :param shuffle: shuffle before splitting
+        :return: rows of this process (all of them when running a single process)
+        """
+        world_size = distributed.get_world_size()
+        if world_size == 1:
+            return rows
+        rows = np.asarray(rows, dtype=np.int64)
+        if shuffle:
+            rows = rows[np.random.RandomState(self.seed + epoch).permutation(len(rows))]
+        return rows[distributed.get_rank()::world_size].tolist()
+
     def __len__(self):
         if self.data_mode == 'train':
             return len(self.train_indices)
@@ -477,10 +601,13 @@ class Data_Utility(data.Dataset):
 class TextDataLoader(data.Dataset):
     """
     Separate dataloader instance
+    If rows is given, inp_rows and outp are indexed through it, so the full
+    encoded corpus can be shared without copying out the split
     """
-    def __init__(self, inp_rows, outp):
+    def __init__(self, inp_rows, outp, rows=None):
         self.inp_rows = inp_rows
         self.outp = outp
+        self.rows = rows
 
     def __getitem__(self, index):
         """
@@ -488,14 +615,84 @@ class TextDataLoader(data.Dataset):
         :param item:
         :return:
         """
-        inp_row = self.inp_rows[index]
-        outp = self.outp[index]
+        row_index = index
+        if self.rows is not None:
+            row_index = self.rows[index]
+        inp_row = self.inp_rows[row_index]
+        outp = self.outp[row_index]
         return inp_row, outp, [index]
 
     def __len__(self):
+        if self.rows is not None:
+            return len(self.rows)
         return len(self.inp_rows)
 
 
+class BucketBatchSampler(data.Sampler):
+    """
+    Batch sampler which groups documents of similar length to minimise padding.
+    Every epoch the indices are shuffled and cut into chunks of `bucket_size` batches,
+    each chunk is sorted by length and split into batches, and the batches are shuffled.
+    """
+    def __init__(self, lengths, batch_size, bucket_size=50):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.bucket_size = bucket_size
+
+    def __iter__(self):
+        indices = random.sample(range(len(self.lengths)), len(self.lengths))
+        chunk_size = self.batch_size * self.bucket_size
+        batches = []
+        for start in range(0, len(indices), chunk_size):
+            chunk = sorted(indices[start:start + chunk_size], key=lambda i: self.lengths[i])
+            batches.extend(self.split_chunk(chunk))
+        random.shuffle(batches)
+        return iter(batches)
+
+    def split_chunk(self, chunk):
+        """
+        Split a length sorted chunk of indices into batches
+        """
+        return [chunk[b:b + self.batch_size] for b in range(0, len(chunk), self.batch_size)]
+
+    def __len__(self):
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+
+class TokenBudgetBatchSampler(BucketBatchSampler):
+    """
+    Batch sampler which fills each batch up to `max_tokens` padded tokens
+    (batch size x longest document) instead of a fixed number of documents,
+    so that peak memory stays stable across short and long documents.
+    A document longer than the budget gets a batch of its own.
+    Chunks of `batch_size * bucket_size` documents are sorted by length as in BucketBatchSampler.
+    """
+    def __init__(self, lengths, max_tokens, batch_size, bucket_size=50):
+        super(TokenBudgetBatchSampler, self).__init__(lengths, batch_size, bucket_size)
+        if max_tokens <= 0:
+            raise RuntimeError("max_batch_tokens should be positive for token budget batching")
+        self.max_tokens = max_tokens
+
+    def split_chunk(self, chunk):
+        batches = []
+        batch = []
+        max_len = 0
+        for index in chunk:
+            doc_len = max(self.lengths[index], 1)
+            if batch and (len(batch) + 1) * max(max_len, doc_len) > self.max_tokens:
+                batches.append(batch)
+                batch = []
+                max_len = 0
+            batch.append(index)
+            max_len = max(max_len, doc_len)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def __len__(self):
+        # number of batches depends on the shuffle, this is the count for a fully sorted epoch
+        return len(self.split_chunk(sorted(range(len(self.lengths)), key=lambda i: self.lengths[i])))
+
 
 ### Helper function
 def collate_fn(data):
@@ -509,18 +706,69 @@ def collate_fn(data):
         padded_rows = torch.zeros(len(rows), max(lengths)).long()
         for i, row in enumerate(rows):
             end = lengths[i]
-            padded_rows[i,:end] = torch.LongTensor(row[:end])
+            padded_rows[i,:end] = torch.from_numpy(np.asarray(row[:end], dtype=np.int64))
         return padded_rows, lengths
 
     data.sort(key=lambda x: len(x[0]), reverse=True)
     src_data, src_labels, src_row_indexes = zip(*data)
     src_data, src_lengths = merge(src_data)
-    src_labels = torch.LongTensor(src_labels)
+    src_labels = torch.from_numpy(np.asarray(src_labels, dtype=np.int64))
 
     batch = Batch(src_data, src_labels, src_lengths, src_row_indexes)
 
     return batch
 
+def tokenize_text(sent, clean=True, tokenization='word'):
+    """
+    tokenize sentence based on mode
+    :param sent: sentence
+    :param clean: run text_cleaner before tokenizing
+    :param tokenization: word/char
+    :return: splitted array
+    """
+    sent = str(sent)
+    if clean:
+        sent = text_cleaner(sent)
+    if tokenization == 'word':
+        return word_tokenize(sent)
+    if tokenization == 'char':
+        return sent.split()
+
+
+def tokenize_shard(texts, clean=True, tokenization='word', max_word_doc=-1, count_pruned=True):
+    """
+    Tokenize a shard of documents, prune them by max words and count the words.
+    Module level so that it can be sent to a process pool
+    :return: list of token lists, Counter
+    """
+    docs = []
+    items = Counter()
+    for text in texts:
+        text = tokenize_text(text, clean, tokenization)
+        if not count_pruned:
+            items.update(text)
+        ## prune docs by max words
+        if max_word_doc > 0 and len(text) > max_word_doc:
+            text = text[:max_word_doc]
+        if count_pruned and len(text) > 0:
+            items.update(text)
+        docs.append(text)
+    return docs, items
+
+
+## Text cleaning rules, compiled once
+CLEANER_RULES = [(re.compile(k), v) for k, v in [
+    (r'>\s+', u'>'),  # remove spaces after a tag opens or closes
+    (r'\s+', u' '),  # replace consecutive spaces
+    (r'\s*<br\s*/?>\s*', u'\n'),  # newline after a <br>
+    (r'</(div)\s*>\s*', u'\n'),  # newline after </p> and </div> and <h1/>...
+    (r'</(p|h\d)\s*>\s*', u'\n\n'),  # newline after </p> and </div> and <h1/>...
+    (r'<head>.*<\s*(/head|body)[^>]*>', u''),  # remove <head> to </head>
+    (r'<a\s+href="([^"]+)"[^>]*>.*</a>', r'\1'),  # show links instead of texts
+    (r'[ \t]*<[^<]*?/?>', u''),  # remove remaining tags
+    (r'^\s+', u'')  # remove spaces at the beginning
+]]
+
 ## Text cleaning function
 def text_cleaner(text):
     text = text.replace(".", "")
@@ -532,21 +780,8 @@ def text_cleaner(text):
     text = text.replace("\"", "")
     text = text.replace("-", "")
     text = text.replace("=", "")
-    rules = [
-        {r'>\s+': u'>'},  # remove spaces after a tag opens or closes
-        {r'\s+': u' '},  # replace consecutive spaces
-        {r'\s*<br\s*/?>\s*': u'\n'},  # newline after a <br>
-        {r'</(div)\s*>\s*': u'\n'},  # newline after </p> and </div> and <h1/>...
-        {r'</(p|h\d)\s*>\s*': u'\n\n'},  # newline after </p> and </div> and <h1/>...
-        {r'<head>.*<\s*(/head|body)[^>]*>': u''},  # remove <head> to </head>
-        {r'<a\s+href="([^"]+)"[^>]*>.*</a>': r'\1'},  # show links instead of texts
-        {r'[ \t]*<[^<]*?/?>': u''},  # remove remaining tags
-        {r'^\s+': u''}  # remove spaces at the beginning
-    ]
-    for rule in rules:
-        for (k, v) in rule.items():
-            regex = re.compile(k)
-            text = regex.sub(v, text)
+    for regex, v in CLEANER_RULES:
+        text = regex.sub(v, text)
         text = text.rstrip()
         text = text.strip()
     return text.lower()
@@ -0,0 +1,131 @@
+## Multi process data parallel training utils
+## Processes are started with torchrun, which sets RANK / WORLD_SIZE / MASTER_ADDR / MASTER_PORT:
+##   torchrun --nproc_per_node 4 -m codes.app.main --config_id <config name>
+## Without these variables everything runs as a single process, and all the functions
+## below are no-ops.
+
+import os
+import torch
+import torch.distributed as dist
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
+import logging
+
+
+def env_rank():
+    """
+    Rank of this process as set by the launcher, usable before init
+    """
+    return int(os.environ.get('RANK', 0))
+
+
+def init(backend='gloo'):
+    """
+    Join the process group if started by a multi process launcher.
+    On cpu, the cores are split between the local processes.
+    :param backend: gloo (cpu) or nccl
+    :return: rank, world_size
+    """
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size > 1 and not dist.is_initialized():
+        dist.init_process_group(backend=backend, init_method='env://')
+        if not torch.cuda.is_available():
+            local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', world_size))
+            torch.set_num_threads(max(1, os.cpu_count() // local_world_size))
+        logging.info("Process {} of {}, backend {}".format(get_rank(), world_size, backend))
+    return get_rank(), get_world_size()
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main():
+    """
+    Only the main process writes logs, statistics and models
+    """
+    return get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def broadcast_parameters(model):
+    """
+    Start every process from the parameters of the main process
+    """
+    if is_distributed():
+        for param in model.state_dict().values():
+            dist.broadcast(param, 0)
+
+
+def all_reduce_gradients(params):
+    """
+    Average the gradients over the processes, in one flat buffer.
+    Parameters without a gradient on this process (e.g. a level head not used by its
+    batches) contribute zeros, so that the buffer has the same layout on every process,
+    and get the averaged gradient
+    """
+    if not is_distributed():
+        return
+    params = [p for p in params if p.requires_grad]
+    if not params:
+        return
+    grads = [p.grad.data if p.grad is not None else torch.zeros_like(p.data) for p in params]
+    flat = _flatten_dense_tensors(grads)
+    dist.all_reduce(flat)
+    flat.div_(get_world_size())
+    for p, grad, reduced in zip(params, grads, _unflatten_dense_tensors(flat, grads)):
+        grad.copy_(reduced)
+        if p.grad is None:
+            p.grad = grad
+
+
+def all_reduce_sum(values):
+    """
+    :param values: list of numbers
+    :return: list of the sums of these numbers over the processes
+    """
+    if not is_distributed():
+        return list(values)
+    tensor = torch.tensor(values, dtype=torch.float64)
+    dist.all_reduce(tensor)
+    return tensor.tolist()
+
+
+def all_mean(values):
+    """
+    Mean of the values of all the processes
+    :param values: list of numbers of this process
+    :return: mean (nan if there are no values at all)
+    """
+    total, count = all_reduce_sum([float(sum(values)), float(len(values))])
+    return total / count if count > 0 else float('nan')
+
+
+def even_batches(loader):
+    """
+    Yield the batches of the loader while every process still has one, so that the
+    processes run the same number of gradient all reduces even with uneven shards
+    """
+    if not is_distributed():
+        for batch in loader:
+            yield batch
+        return
+    batches = iter(loader)
+    while True:
+        batch = next(batches, None)
+        has_batch = torch.tensor([0 if batch is None else 1])
+        dist.all_reduce(has_batch, op=dist.ReduceOp.MIN)
+        if has_batch.item() == 0:
+            return
+        yield batch
@@ -0,0 +1,163 @@
+## Pretrained word embedding loading
+## Reads GloVe / word2vec text files in a single pass, only parsing the vectors
+## of words in the vocab. Optionally keeps a binary copy of the full file which
+## is memory-mapped on later runs, whatever the data path or vocab.
+
+import os
+import pickle as pkl
+import numpy as np
+import torch
+from tqdm import tqdm
+import logging
+
+VECTORS_FILE = 'vectors.f32'
+WORDS_FILE = 'words.pkl'
+
+
+def get_cache_dir(embedding_file):
+    return embedding_file + '.cache'
+
+
+def get_source_stamp(embedding_file):
+    """
+    Size and modification time of the embedding file, a cache built from another version is stale
+    """
+    stat = os.stat(embedding_file)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+
+def parse_line(line, embedding_dim):
+    """
+    Split one line of the embedding file into the word and its vector.
+    Words may contain spaces (eg. in glove.840B), so the vector is the last embedding_dim fields
+    :return: word, float32 vector, or None, None if the line is not a vector (eg. word2vec header)
+    """
+    parts = line.rstrip().rsplit(' ', embedding_dim)
+    if len(parts) != embedding_dim + 1:
+        return None, None
+    try:
+        return parts[0], np.array(parts[1:], dtype=np.float32)
+    except ValueError:
+        return None, None
+
+
+def scan_embedding_file(embedding_file, word2id, embedding_dim, embeddings, cache_dir=None):
+    """
+    Single pass over the embedding file. Only the lines of vocab words are parsed,
+    unless cache_dir is given, in which case every vector is parsed and written to the cache.
+    :param embedding_file: pre-trained vector file, eg glove.txt
+    :param word2id: vocab
+    :param embedding_dim: dimensions, eg 300
+    :param embeddings: vocab x embedding_dim numpy array, filled in place
+    :param cache_dir: if not None, directory to write the full binary cache into
+    :return: number of vocab words found
+    """
+    found = 0
+    malformed = 0
+    words = []
+    vec_fp = None
+    if cache_dir is not None:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        vec_fp = open(os.path.join(cache_dir, VECTORS_FILE), 'wb')
+    pbar = tqdm(total=os.path.getsize(embedding_file), unit='B', unit_scale=True)
+    with open(embedding_file, 'rb') as f:
+        for line_no, raw_line in enumerate(f):
+            pbar.update(len(raw_line))
+            line = raw_line.decode('utf-8', errors='replace').rstrip()
+            if vec_fp is None:
+                # vocab filter on the first field before parsing the floats, lines of words
+                # with spaces (more fields) and malformed lines (less fields) are always parsed
+                space = line.find(' ')
+                first = line[:space] if space >= 0 else line
+                if first not in word2id and line.count(' ') == embedding_dim:
+                    continue
+            word, vec = parse_line(line, embedding_dim)
+            if word is None:
+                # first line of word2vec files (count and dimension) is skipped
+                if line and not (line_no == 0 and line.count(' ') == 1):
+                    malformed += 1
+                continue
+            if vec_fp is not None:
+                vec.tofile(vec_fp)
+                words.append(word)
+            if word in word2id:
+                embeddings[word2id[word]] = vec
+                found += 1
+    pbar.close()
+    if malformed > 0:
+        logging.warning("Skipped {} malformed lines (not a word and {} floats) in {}".format(
+            malformed, embedding_dim, embedding_file))
+    if vec_fp is not None:
+        vec_fp.close()
+        # the words file is written last and marks a complete cache
+        tmp_path = os.path.join(cache_dir, WORDS_FILE + '.tmp')
+        with open(tmp_path, 'wb') as fp:
+            pkl.dump({'words': words, 'embedding_dim': embedding_dim,
+                      'source': get_source_stamp(embedding_file)}, fp)
+        os.replace(tmp_path, os.path.join(cache_dir, WORDS_FILE))
+        logging.info("Cached {} vectors in {}".format(len(words), cache_dir))
+    return found
+
+
+def read_cache_index(cache_dir, embedding_file):
+    """
+    :return: words and dimension of the cache, or None if there is no complete cache
+        of the current embedding file
+    """
+    words_path = os.path.join(cache_dir, WORDS_FILE)
+    if not os.path.exists(words_path):
+        return None
+    with open(words_path, 'rb') as fp:
+        cache = pkl.load(fp)
+    if cache.get('source') != get_source_stamp(embedding_file):
+        logging.warning("Embedding cache {} is stale, {} has changed".format(cache_dir, embedding_file))
+        return None
+    return cache
+
+
+def read_cache(cache_dir, cache, word2id, embedding_dim, embeddings):
+    """
+    Fill the vocab embeddings from the memory-mapped binary cache
+    :param cache: cache index, see read_cache_index
+    :return: number of vocab words found
+    """
+    if cache['embedding_dim'] != embedding_dim:
+        raise RuntimeError("Embedding cache {} has dimension {}, expected {}".format(
+            cache_dir, cache['embedding_dim'], embedding_dim))
+    vectors = np.memmap(os.path.join(cache_dir, VECTORS_FILE), dtype=np.float32, mode='r',
+                        shape=(len(cache['words']), embedding_dim))
+    vocab_ids = []
+    rows = []
+    for row, word in enumerate(cache['words']):
+        if word in word2id:
+            vocab_ids.append(word2id[word])
+            rows.append(row)
+    embeddings[vocab_ids] = vectors[rows]
+    return len(rows)
+
+
+def load_pretrained(embedding_file, word2id, embedding_dim=300, use_cache=False):
+    """
+    Build the vocab embedding matrix from pre-trained vectors. Words not in the
+    pre-trained file are initialized from a normal distribution.
+    :param embedding_file: pre-trained vector file, eg glove.txt
+    :param word2id: vocab
+    :param embedding_dim: dimensions, eg 300
+    :param use_cache: read / write the binary cache next to the embedding file
+    :return: embedding matrix, vocab x embedding_dim
+    """
+    if not embedding_file:
+        raise RuntimeError(
+            'Tried to load embeddings with no embedding file.')
+    embeddings = np.random.normal(0, 1, (len(word2id), embedding_dim)).astype(np.float32)
+    cache_dir = get_cache_dir(embedding_file)
+    cache = read_cache_index(cache_dir, embedding_file) if use_cache else None
+    if cache is not None:
+        logging.info("Reading embeddings from cache {}".format(cache_dir))
+        found = read_cache(cache_dir, cache, word2id, embedding_dim, embeddings)
+    else:
+        found = scan_embedding_file(embedding_file, word2id, embedding_dim, embeddings,
+                                    cache_dir=cache_dir if use_cache else None)
+    logging.info('Done words : {}'.format(found))
+    return torch.from_numpy(embeddings)
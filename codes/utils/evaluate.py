@@ -30,6 +30,7 @@ def get_args():
     parser.add_argument("-o","--output", type=str, help="file to write the output", default="output.csv")
     parser.add_argument("-c","--confidence", type=float, help="confidence to measure pruned accuracy", default=0.0)
     parser.add_argument("-n","--num", type=int, help="number of evals (-1 for all)", default=-1)
+    parser.add_argument("-b","--batch_size", type=int, help="documents per batch (0 to predict one by one)", default=64)
 
     args = parser.parse_args()
     return args
@@ -50,6 +51,90 @@ def predict(test_df, row_id, trainer, src_text, src_len, labels, data, mode='ove
         test_df.at[row_id, 'pred_{}_{}'.format(mode, idx)] = pred
     return test_df, attns, probs
 
+def split_rows(level_outputs, lengths):
+    """
+    Split per level batch outputs (attentions / probabilities) into per document outputs.
+    The batch axis is kept with a size of 1, so that each document has the same layout
+    as when predicting one by one
+    :param level_outputs: list over levels of batch arrays, or of lists with one array per document
+    :param lengths: document lengths, to strip the padding of batched attentions
+    :return: list over documents of list over levels
+    """
+    rows = []
+    for pos, length in enumerate(lengths):
+        row = []
+        for out in level_outputs:
+            if out is None:
+                row.append(None)
+            elif type(out) == list or out.ndim == 2:
+                row.append(out[pos:pos + 1])
+            else:
+                row.append(out[pos:pos + 1][..., :length])
+        rows.append(row)
+    return rows
+
+def predict_batched(test_df, trainer, data, model_params, batch_size=64):
+    """
+    Predict the test documents in length sorted batches. Each batch is encoded once,
+    and decoded both with (exact) and without (overall) teacher forcing.
+    Predictions are written column wise at the end.
+    :param test_df: test dataframe
+    :param trainer: Trainer
+    :param data: Data_Utility
+    :param model_params: params
+    :param batch_size: documents per batch
+    :return: test_df, attentions, probabilities (per document, as in the one by one mode)
+    """
+    levels = model_params['levels']
+    unk = data.word2id[constants.UNK_WORD]
+    for i in range(levels):
+        test_df['pred_{}'.format(i)] = ''
+        test_df['attn_{}'.format(i)] = ''
+    rows = []
+    recon_texts = []
+    for text, row_labels in zip(test_df['text'], zip(*[test_df['l{}'.format(l + 1)] for l in range(levels)])):
+        text = data.tokenize(text.lower())
+        text = [data.word2id.get(w, unk) for w in text]
+        recon_texts.append(' '.join([data.id2word[w] for w in text]))
+        labels = [0]
+        labels.extend([data.label2id['l{}_{}'.format(l, data.y_class2id['l' + str(l + 1)][str(row_labels[l])])]
+                       for l in range(levels)])
+        rows.append((text, labels, [len(rows)]))
+    test_df['recon_text'] = recon_texts
+
+    modes = ['overall', 'exact']
+    pred_ids = {mode: np.zeros((len(rows), levels), dtype=np.int64) for mode in modes}
+    attentions = [None] * len(rows)
+    probabilities = [None] * len(rows)
+    order = sorted(range(len(rows)), key=lambda r: len(rows[r][0]), reverse=True)
+    pb = tqdm(total=len(rows))
+    with torch.no_grad():
+        for start in range(0, len(order), batch_size):
+            batch = data_utils.collate_fn([rows[r] for r in order[start:start + batch_size]])
+            batch.to_device(decoders.device)
+            row_ids = [r[0] for r in batch.src_indexes]
+            outputs = trainer.inferenceNLLLoss(batch.inp, batch.inp_lengths, batch.outp)
+            batch_attns = {}
+            batch_probs = {}
+            for mode in modes:
+                _, _, attns, preds, _, _, _, probs = outputs[mode]
+                pred_ids[mode][row_ids] = np.stack(preds, axis=1)
+                batch_attns[mode] = split_rows(attns, batch.inp_lengths)
+                batch_probs[mode] = split_rows(probs, batch.inp_lengths)
+            for pos, row_id in enumerate(row_ids):
+                attentions[row_id] = [batch_attns['overall'][pos], batch_attns['exact'][pos]]
+                probabilities[row_id] = batch_probs['overall'][pos]
+            pb.update(len(row_ids))
+    pb.close()
+
+    for mode in modes:
+        for level in range(levels):
+            level_ids = pred_ids[mode][:, level]
+            id2class = {p: str(data.y_id2class['l' + str(level + 1)][int(data.id2label[p].split('_')[1])])
+                        for p in np.unique(level_ids).tolist()}
+            test_df['pred_{}_{}'.format(mode, level)] = [id2class[p] for p in level_ids.tolist()]
+    return test_df, attentions, probabilities
+
 def calculate_metrics(layers, test_file, mode='overall'):
     print("Calculating metrics for mode : {}".format(mode))
     print("------------------------------------------------")
@@ -65,18 +150,11 @@ def calculate_metrics(layers, test_file, mode='overall'):
         print("Acc {}, Sk_accuracy {}, Recall {}, F1 Score {}, Precision {}".format(acc, sk_acc, sk_rec, sk_f1, sk_precision))
     print('================================================')
 
-def evaluate_test(trainer, data, test_file_loc, output_file_loc, model_params, total=-1):
+def predict_rows(test_file, trainer, data, model_params, total=-1):
     """
-    Evaluate and print metrics
-    :param model: Trainer (use trainer.model.eval() to disable dropout / batchnorm)
-    :param test_file_loc: testing file
-    :param output_file_loc: output file
-    :param model_params: params
-    :param layers: default 3
-    :return: None
+    Predict the test documents one by one
+    :return: test_file, attentions, probabilities
     """
-    layers = model_params['levels']
-    test_file = pd.read_csv('../../data/' + test_file_loc)
     for i in range(model_params['levels']):
         test_file['pred_{}'.format(i)] = ''
         test_file['attn_{}'.format(i)] = ''
@@ -133,6 +211,30 @@ def evaluate_test(trainer, data, test_file_loc, output_file_loc, model_params, t
         if ct == total:
             break
     pb.close()
+    return test_file, attentions, probabilities
+
+def evaluate_test(trainer, data, test_file_loc, output_file_loc, model_params, total=-1, batch_size=0):
+    """
+    Evaluate and print metrics
+    :param model: Trainer (use trainer.model.eval() to disable dropout / batchnorm)
+    :param test_file_loc: testing file
+    :param output_file_loc: output file
+    :param model_params: params
+    :param layers: default 3
+    :param batch_size: if > 0, predict in batches of batch_size documents
+    :return: None
+    """
+    layers = model_params['levels']
+    test_file = pd.read_csv('../../data/' + test_file_loc)
+    if batch_size > 0:
+        if total != -1:
+            test_file = test_file[:total].copy()
+        logging.info("Starting batched prediction ...")
+        test_file, attentions, probabilities = predict_batched(test_file, trainer, data, model_params,
+                                                               batch_size=batch_size)
+    else:
+        test_file, attentions, probabilities = predict_rows(test_file, trainer, data, model_params,
+                                                            total=total)
     # Calculate Metrics
     calculate_metrics(layers, test_file, mode='overall')
     calculate_metrics(layers, test_file, mode='exact')
@@ -191,7 +293,8 @@ if __name__ == '__main__':
     trainer = decoders.Trainer(model=model, **model_params)
 
     trainer.model.eval()
-    evaluate_test(trainer, data, args.file, args.output, model_params)
+    evaluate_test(trainer, data, args.file, args.output, model_params, total=args.num,
+                  batch_size=args.batch_size)
 
 
 
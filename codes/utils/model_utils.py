@@ -4,7 +4,11 @@ import torch.nn as nn
 import os
 from os.path import dirname, abspath
 import json
+import random
+import queue
+import threading
 import numpy as np
+from codes.utils import distributed
 import logging
 logging.basicConfig(
     level=logging.INFO,
@@ -23,14 +27,109 @@ def create_save_dir(exp_name):
     # going up 3 levels
     base_dir = str(os.path.dirname(os.path.realpath(__file__)).split('codes')[0])
     save_path_base = os.path.join(base_dir, 'saved', exp_name)
-    if not os.path.exists(save_path_base):
-        os.makedirs(save_path_base)
+    os.makedirs(save_path_base, exist_ok=True)
     return save_path_base
 
-def save_model(model, epoch=0, step=0, exp_name='', params=None):
-    """ Save model, model params
+def atomic_save(obj, path):
+    """
+    torch.save to a temporary file which is then renamed, so that an interrupted
+    write never leaves a truncated file behind
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as fp:
+        torch.save(obj, fp)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(tmp_path, path)
+
+def atomic_json_dump(obj, path):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as fp:
+        json.dump(obj, fp)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(tmp_path, path)
+
+def save_parameters(exp_name='', params=None):
+    """ Save the model params, once per experiment
     Check if model params serializable type then save
     """
+    if not distributed.is_main():
+        return
+    save_path_base = create_save_dir(exp_name)
+    # nix params which are not json serializable
+    to_save = {}
+    for key, val in params.items():
+        if is_jsonable(val):
+            to_save[key] = val
+    atomic_json_dump(to_save, save_path_base + '/parameters.json')
+    logging.info("Saved params")
+
+def snapshot(obj):
+    """
+    Copy the tensors of a (nested) state dict to cpu memory, so that it can be
+    written while training goes on updating the originals
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((key, snapshot(val)) for key, val in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(val) for val in obj)
+    return obj
+
+class CheckpointWriter():
+    """
+    Run the model and checkpoint writes either synchronously or, if async_write,
+    in order on a background thread. The write queue holds at most one write besides
+    the running one: submitting more waits for the previous writes (backpressure).
+    Callers which snapshot the state should wait first, so that only one snapshot
+    is held at a time.
+    Errors of background writes are raised by the next submit or wait.
+    """
+    def __init__(self, async_write=False):
+        self.async_write = async_write
+        self.error = None
+        if async_write:
+            self.queue = queue.Queue(maxsize=1)
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def submit(self, fn, *args, **kwargs):
+        if not self.async_write:
+            fn(*args, **kwargs)
+            return
+        self.raise_error()
+        self.queue.put((fn, args, kwargs))
+
+    def run(self):
+        while True:
+            fn, args, kwargs = self.queue.get()
+            try:
+                fn(*args, **kwargs)
+            except Exception as e:
+                logging.exception("Background checkpoint write failed")
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def wait(self):
+        """Block until all the submitted writes are done"""
+        if self.async_write:
+            self.queue.join()
+        self.raise_error()
+
+    def raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+def save_model(model, epoch=0, step=0, exp_name='', params=None):
+    """ Save model
+    With multiple processes, only the main process saves
+    """
+    if not distributed.is_main():
+        return
 
     save_path_base = create_save_dir(exp_name)
     save_path = save_path_base + '/' + \
@@ -39,18 +138,95 @@ def save_model(model, epoch=0, step=0, exp_name='', params=None):
     if hasattr(model, "save_state_dict"):
         model.save_state_dict(save_path)
     else:
-        torch.save(
-            model.state_dict(),
-            save_path
-        )
-    logging.info("Model saved, now saving parameters")
-    # nix params which are not json serializable
-    to_save = {}
-    for key, val in params.items():
-        if is_jsonable(val):
-            to_save[key] = val
-    json.dump(to_save, open(save_path_base + '/parameters.json', 'w'))
-    logging.info("Saved model and params")
+        atomic_save(model.state_dict(), save_path)
+        logging.info("Model saved")
+
+def get_rng_state():
+    state = {
+        'torch': torch.get_rng_state(),
+        'numpy': np.random.get_state(),
+        'random': random.getstate()
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+def set_rng_state(state):
+    torch.set_rng_state(state['torch'])
+    np.random.set_state(state['numpy'])
+    random.setstate(state['random'])
+    if torch.cuda.is_available() and 'cuda' in state:
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+def save_checkpoint(state, exp_name='', epoch=0, valid_loss=None, keep_last=0, keep_best=True,
+                    writer=None, model_file=None):
+    """ Save a resumable training checkpoint
+    Checkpoints are listed in checkpoints.json with their validation loss. After saving,
+    only the last keep_last checkpoints (all if 0) and the best one (if keep_best) are kept.
+    With multiple processes, only the main process saves
+    :param state: dict of the training state, see run_experiment
+    :param valid_loss: validation loss of the epoch, lower is better
+    :param writer: CheckpointWriter, to write in the background from a snapshot
+    :param model_file: if set, state['model'] is also saved as this standalone model file
+        (as save_model does), from the same snapshot
+    """
+    if not distributed.is_main():
+        return
+    if writer is not None:
+        # wait for the previous write before taking the snapshot, so that there is
+        # only one cpu copy of the state at a time
+        writer.wait()
+        writer.submit(write_checkpoint, snapshot(state), exp_name, epoch, valid_loss, keep_last, keep_best,
+                      model_file)
+    else:
+        write_checkpoint(state, exp_name, epoch, valid_loss, keep_last, keep_best, model_file)
+
+def write_checkpoint(state, exp_name, epoch, valid_loss, keep_last, keep_best, model_file=None):
+    save_path_base = create_save_dir(exp_name)
+    if model_file:
+        logging.info("Saving model in {}".format(os.path.join(save_path_base, model_file)))
+        atomic_save(state['model'], os.path.join(save_path_base, model_file))
+    file_name = 'checkpoint_epoch_{}.pt'.format(epoch)
+    logging.info("Saving checkpoint in {}".format(os.path.join(save_path_base, file_name)))
+    atomic_save(state, os.path.join(save_path_base, file_name))
+    index = [ckpt for ckpt in read_checkpoint_index(save_path_base) if ckpt['file'] != file_name]
+    index.append({'file': file_name, 'epoch': epoch,
+                  'valid_loss': None if valid_loss is None else float(valid_loss)})
+    keep = set(ckpt['file'] for ckpt in index)
+    if keep_last > 0:
+        keep = set(ckpt['file'] for ckpt in sorted(index, key=lambda c: c['epoch'])[-keep_last:])
+        scored = [ckpt for ckpt in index if ckpt['valid_loss'] is not None]
+        if keep_best and scored:
+            keep.add(min(scored, key=lambda c: c['valid_loss'])['file'])
+    # update the index before removing files, so that it never lists a missing checkpoint
+    atomic_json_dump([ckpt for ckpt in index if ckpt['file'] in keep],
+                     os.path.join(save_path_base, 'checkpoints.json'))
+    for ckpt in index:
+        if ckpt['file'] not in keep:
+            os.remove(os.path.join(save_path_base, ckpt['file']))
+    logging.info("Checkpoint saved")
+
+def read_checkpoint_index(save_path_base):
+    index_path = os.path.join(save_path_base, 'checkpoints.json')
+    if not os.path.exists(index_path):
+        return []
+    return json.load(open(index_path, 'r'))
+
+def load_checkpoint(exp_name='', path=''):
+    """ Load a training checkpoint
+    :param path: checkpoint file, absolute or relative to the experiment save folder.
+        If empty, the last checkpoint of the experiment
+    :return: state dict, or None if there is no checkpoint
+    """
+    save_path_base = create_save_dir(exp_name)
+    if not path:
+        index = read_checkpoint_index(save_path_base)
+        if not index:
+            return None
+        path = max(index, key=lambda c: c['epoch'])['file']
+    path = os.path.join(save_path_base, path)
+    logging.info("Loading checkpoint {}".format(path))
+    return torch.load(path, map_location='cpu', weights_only=False)
 
 def get_mlp(input_dim, output_dim, num_layers=2, dropout=0):
     network_list = []
@@ -75,20 +251,28 @@ class SLTR():
         self.epochs = epochs
         self.batch_size = batch_size
         self.num_train = num_train
-        self.updates = num_train // batch_size
+        # the last partial batch is a step too, at least one step per epoch and before the cut
+        self.updates = max(int(np.ceil(num_train / batch_size)), 1)
         self.T = self.updates * epochs
         self.cut_frac = cut_frac
         self.ratio = ratio
         self.lr_max = lr_max
-        self.cut = np.floor(self.T * cut_frac)
+        self.cut = max(np.floor(self.T * cut_frac), 1)
         self.t = 0
 
+    def state_dict(self):
+        return {'t': self.t}
+
+    def load_state_dict(self, state):
+        self.t = state['t']
+
     def step(self, optimizer):
         self.t += 1
         if self.t < self.cut:
             p = self.t / self.cut
         else:
-            p =  1 - (self.t - self.cut) / (self.cut * (1/self.cut_frac - 1))
+            # the floored cut can leave a few steps past the end of the decay
+            p =  max(1 - (self.t - self.cut) / (self.cut * (1/self.cut_frac - 1)), 0)
         new_lr = (self.lr_max * (1 + p*(self.ratio - 1))) / self.ratio
         if self.t % self.updates == 0:
             logging.info("LR : {}".format(new_lr))
@@ -97,3 +281,47 @@ class SLTR():
         return optimizer
 
 
+class MixedPrecision():
+    """
+    Automatic mixed precision training
+    precision : fp32 (disabled), bf16 or fp16. With fp16 the loss is scaled before
+    backward so that small gradients do not underflow, and unscaled before clipping.
+    """
+    dtypes = {'fp32': torch.float32, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+    def __init__(self, precision='fp32', device_type='cpu'):
+        if precision not in self.dtypes:
+            raise NotImplementedError("precision {} not implemented".format(precision))
+        self.precision = precision
+        self.device_type = device_type
+        self.dtype = self.dtypes[precision]
+        self.enabled = precision != 'fp32'
+        self.scaler = torch.amp.GradScaler(device_type, enabled=(precision == 'fp16'))
+
+    def autocast(self):
+        return torch.autocast(device_type=self.device_type, dtype=self.dtype, enabled=self.enabled)
+
+    def backward(self, loss):
+        self.scaler.scale(loss).backward()
+
+    def state_dict(self):
+        return self.scaler.state_dict()
+
+    def load_state_dict(self, state):
+        self.scaler.load_state_dict(state)
+
+    def step(self, optimizer, params, clip_grad, grad_factor=1):
+        """
+        :param grad_factor: multiply the gradients by this factor before clipping
+            (to average a shorter last gradient accumulation window)
+        """
+        # with multiple processes, average the gradients of all the processes first
+        distributed.all_reduce_gradients(params)
+        self.scaler.unscale_(optimizer)
+        if grad_factor != 1:
+            for p in params:
+                if p.grad is not None:
+                    p.grad.mul_(grad_factor)
+        nn.utils.clip_grad_norm(params, clip_grad)
+        self.scaler.step(optimizer)
+        self.scaler.update()
@@ -0,0 +1,149 @@
+## Opt-in timers for the stages of the training loop
+## Stages are timed with
+##   with profiler.timer('encode'):
+##       ...
+## where profiler is the module level instance below, so that models and trainers can
+## time their own stages. When disabled (default) timer returns a shared no-op context.
+
+import time
+from contextlib import contextmanager
+import numpy as np
+import torch
+from codes.utils import distributed
+import logging
+
+
+class NullTimer():
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+class Timer():
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.profiler.synchronize()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.profiler.synchronize()
+        self.profiler.record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class Profiler():
+    """
+    Collect the time spent per named stage and per training step.
+    step() closes a training step, summary() writes the per step timings of the epoch as
+    tensorboard histograms and logs a table with the total, mean and percentiles per stage.
+    On gpu, the device is synchronized around each timer so that the timings are exact
+    (which slows down training, hence opt-in).
+    """
+    def __init__(self):
+        self.enabled = False
+        self.active = False
+        self.writer = None
+        self.null_timer = NullTimer()
+        self.reset()
+
+    def configure(self, enabled=False, writer=None):
+        """
+        :param enabled: time the stages
+        :param writer: tensorboard SummaryWriter, None to only log the summary table
+        """
+        self.enabled = enabled
+        self.active = enabled
+        self.writer = writer
+        self.reset()
+
+    def reset(self):
+        self.current = {}
+        self.durations = {}
+        self.steps = 0
+
+    def timer(self, name):
+        if not self.active:
+            return self.null_timer
+        return Timer(self, name)
+
+    def iterate(self, iterable, name='data'):
+        """
+        Yield from iterable, timing the wait for each item
+        """
+        items = iter(iterable)
+        while True:
+            with self.timer(name):
+                item = next(items, StopIteration)
+            if item is StopIteration:
+                return
+            yield item
+
+    @contextmanager
+    def paused(self):
+        """
+        Do not time the stages run inside, e.g. validation
+        """
+        active = self.active
+        self.active = False
+        try:
+            yield
+        finally:
+            self.active = active
+
+    def synchronize(self):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+
+    def record(self, name, duration):
+        self.current[name] = self.current.get(name, 0.0) + duration
+
+    def step(self):
+        """
+        Close the current training step
+        """
+        if not self.enabled:
+            return
+        for name, duration in self.current.items():
+            self.durations.setdefault(name, []).append(duration)
+        self.current = {}
+        self.steps += 1
+
+    def summary(self, epoch=0):
+        """
+        Write the per step histograms and log the summary table of the epoch, then reset
+        """
+        if not self.enabled:
+            return
+        if self.steps == 0:
+            return
+        # stages run after the last step (e.g. the last optimizer step of the epoch) belong to it
+        for name, duration in self.current.items():
+            if name in self.durations:
+                self.durations[name][-1] += duration
+            else:
+                self.durations[name] = [duration]
+        self.current = {}
+        total = sum(sum(durations) for durations in self.durations.values())
+        lines = ['{:<24} {:>7} {:>10} {:>10} {:>10} {:>10} {:>7}'.format(
+            'stage', 'steps', 'total s', 'mean ms', 'p50 ms', 'p95 ms', '%')]
+        for name, durations in sorted(self.durations.items(), key=lambda kv: -sum(kv[1])):
+            durations = np.asarray(durations)
+            lines.append('{:<24} {:>7} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f} {:>7.1f}'.format(
+                name, len(durations), durations.sum(), durations.mean() * 1000,
+                np.percentile(durations, 50) * 1000, np.percentile(durations, 95) * 1000,
+                100 * durations.sum() / total if total > 0 else 0))
+            if self.writer is not None:
+                self.writer.add_histogram('profile/{}'.format(name), durations * 1000, epoch)
+                self.writer.add_scalar('profile_mean_ms/{}'.format(name), durations.mean() * 1000, epoch)
+        if distributed.is_main():
+            logging.info("Profile of epoch {} ({} steps)\n{}".format(epoch, self.steps, '\n'.join(lines)))
+        self.reset()
+
+
+profiler = Profiler()
@@ -19,29 +19,85 @@ import pdb
 
 
 from codes.utils import model_utils as mu
+from codes.utils import distributed
+
+
+class MetricAccumulator():
+    """
+    Running sums and counts of named metrics, so that the memory does not grow
+    with the number of batches
+    """
+    def __init__(self):
+        self.sums = {}
+        self.counts = {}
+
+    def add(self, name, value, count=1):
+        """
+        :param count: number of values summed in value
+        """
+        self.sums[name] = self.sums.get(name, 0.0) + float(value)
+        self.counts[name] = self.counts.get(name, 0) + count
+
+    def add_total(self, name, value):
+        """
+        add to the sum only, for counters which are not averaged
+        """
+        self.sums[name] = self.sums.get(name, 0.0) + value
+
+    def add_levels(self, name, values, count=1):
+        """
+        :param values: one value per level, added as name_level
+        """
+        for level, value in enumerate(values):
+            self.add('{}_{}'.format(name, level), value, count)
+
+    def total(self, name):
+        """
+        sum of the values over all the processes
+        """
+        return distributed.all_reduce_sum([self.sums.get(name, 0.0)])[0]
+
+    def mean(self, name):
+        """
+        mean of the values over all the processes (nan if there are no values)
+        """
+        total, count = distributed.all_reduce_sum([self.sums.get(name, 0.0), float(self.counts.get(name, 0))])
+        return total / count if count > 0 else float('nan')
 
 
 class Statistics():
     """
     Class to collect training and validation statistics.
     Also collect validation samples and attention for later inspection
+    Metrics are kept as running sums (MetricAccumulator) and confusion matrix counters.
+    The raw validation predictions are only kept if keep_predictions is set.
+    Training metrics given as device tensors (update_train_device) are summed on device,
+    and copied to the host once every metrics_interval steps.
+    With multiple processes, the metrics are averaged over all the processes,
+    and only the main process logs and writes them
     """
-    def __init__(self, batch_size=0, max_levels=3, exp_name='', data=None, n_heads=[], level=-1):
+    def __init__(self, batch_size=0, max_levels=3, exp_name='', data=None, n_heads=[], level=-1,
+                 keep_predictions=False, metrics_interval=50):
         self.epoch = -1
         self.step = 0
-        self.train_accuracy = []
         self.batch_size = batch_size
         self.max_levels = max_levels
         self.exp_name = exp_name
         self.data = data
         self.n_heads = n_heads
         self.level = level
+        self.keep_predictions = keep_predictions
+        self.metrics_interval = metrics_interval
+        self.label_ranges = self.get_label_ranges()
         self.base_dir = str(os.path.dirname(os.path.realpath(__file__)).split('codes')[0])
         self.log_dir = os.path.join(self.base_dir, 'logs')
-        writer_dir = os.path.join(self.log_dir,exp_name)
-        if not os.path.exists(writer_dir):
-            os.makedirs(writer_dir)
-        self.writer = SummaryWriter(log_dir=writer_dir)
+        self.is_main = distributed.is_main()
+        self.writer = None
+        if self.is_main:
+            writer_dir = os.path.join(self.log_dir,exp_name)
+            if not os.path.exists(writer_dir):
+                os.makedirs(writer_dir)
+            self.writer = SummaryWriter(log_dir=writer_dir)
         self.output = {} # json file to store validation examples. should contain true and predicted labels (actual class names), validation examples, and generated attentions per epoch.
         self.output['train_indices'] = data.train_indices
         self.output['val_indices'] = data.test_indices
@@ -53,27 +109,109 @@ class Statistics():
         self.step = 0
         self.calc_start = time.time()
         self.output[self.epoch] = {'attentions':[], 'val_indices':[], 'predictions':[]}
-        save_path_base = mu.create_save_dir(self.exp_name)
-        #json.dump(self.output, open(save_path_base + '/val_logs.txt','w'))
-        logging.info("Epoch : {}".format(self.epoch))
+        if self.is_main:
+            save_path_base = mu.create_save_dir(self.exp_name)
+            #json.dump(self.output, open(save_path_base + '/val_logs.txt','w'))
+        self.info("Epoch : {}".format(self.epoch))
+
+
+    def state_dict(self):
+        """Counters to resume from a checkpoint"""
+        return {'epoch': self.epoch, 'step': self.step}
 
+    def load_state_dict(self, state):
+        self.epoch = state['epoch']
+        self.step = state['step']
+
+    def get_label_ranges(self):
+        """
+        Decoder label ids of each level are contiguous. When a single level is chosen,
+        the targets are the class ids of the level, starting from 0
+        :return: list of (first label id, number of labels) per level
+        """
+        ranges = []
+        for level in range(self.max_levels):
+            data_level = level if self.level == -1 else self.level
+            ids = [v for k, v in self.data.label2id.items() if k.startswith('l{}_'.format(data_level))]
+            if self.level != -1:
+                ranges.append((0, len(ids)))
+            else:
+                ranges.append((min(ids), len(ids)) if ids else (0, 0))
+        return ranges
 
     def update_train(self, train_loss, train_accuracy, log_loss=0):
-        self.train['train_loss'].append(train_loss)
-        self.train['train_accuracy'].append(train_accuracy)
-        self.train['train_log_loss'].append(log_loss)
+        self.train.add('train_loss', train_loss)
+        self.train.add_levels('train_accuracy', train_accuracy)
+        self.train.add('train_log_loss', log_loss)
         self.step +=1
 
+    def update_train_device(self, train_loss, train_accuracy, log_loss):
+        """
+        Same as update_train, without syncing with the device
+        :param train_loss: loss tensor
+        :param train_accuracy: accuracy tensor per level
+        :param log_loss: log loss tensor
+        """
+        values = torch.stack([train_loss.detach().float(), log_loss.detach().float()] +
+                             [acc.detach().float() for acc in train_accuracy])
+        if self.device_sums is None:
+            self.device_sums = values
+        else:
+            self.device_sums += values
+        self.device_steps += 1
+        self.step += 1
+        if self.device_steps >= self.metrics_interval:
+            self.flush_train()
+
+    def flush_train(self):
+        """
+        Copy the device sums of the training metrics to the host
+        """
+        if self.device_sums is None:
+            return
+        train_loss, log_loss, *train_accuracy = self.device_sums.tolist()
+        self.train.add('train_loss', train_loss, self.device_steps)
+        self.train.add('train_log_loss', log_loss, self.device_steps)
+        self.train.add_levels('train_accuracy', train_accuracy, self.device_steps)
+        self.device_sums = None
+        self.device_steps = 0
+
+    def update_padding(self, lengths):
+        """
+        Track how many of the padded batch positions are real tokens
+        :param lengths: document lengths of one batch
+        """
+        self.train.add_total('real_tokens', sum(lengths))
+        self.train.add_total('padded_tokens', len(lengths) * max(lengths))
+
+    def update_confusion(self, preds, correct, mode='exact'):
+        """
+        Count the (correct, predicted) pairs of each level. Labels outside of the level
+        are counted in the last row / column.
+        :param preds: list over levels of predicted label ids
+        :param correct: list over levels of correct label ids
+        """
+        for level, (pred, gold) in enumerate(zip(preds, correct)):
+            first, size = self.label_ranges[level]
+            pred = np.asarray(pred).reshape(-1) - first
+            gold = np.asarray(gold).reshape(-1) - first
+            pred[(pred < 0) | (pred >= size)] = size
+            gold[(gold < 0) | (gold >= size)] = size
+            np.add.at(self.confusion[mode][level], (gold, pred), 1)
+
     def update_validation(self, validation_loss, validation_accuracy, attn=None, src=None,
                           preds=None, correct=None, correct_confs=None,incorrect_confs=None,
                           log_loss=0, mode='exact', **kwargs):
-        self.val[mode]['validation_loss'].append(validation_loss)
-        self.val[mode]['validation_log_loss'].append(log_loss)
-        self.val[mode]['validation_accuracy'].append(validation_accuracy)
-        self.val[mode]['predicted_labels'].append(preds)
-        self.val[mode]['correct_labels'].append(correct)
-        self.val[mode]['correct_confs'].append(correct_confs)
-        self.val[mode]['incorrect_confs'].append(incorrect_confs)
+        self.val[mode].add('validation_loss', validation_loss)
+        self.val[mode].add('validation_log_loss', log_loss)
+        self.val[mode].add_levels('validation_accuracy', validation_accuracy)
+        self.val[mode].add_levels('correct_confs', correct_confs)
+        self.val[mode].add_levels('incorrect_confs', incorrect_confs)
+        if preds is not None and correct is not None:
+            self.update_confusion(preds, correct, mode=mode)
+            if self.keep_predictions:
+                self.predictions[mode]['predicted_labels'].append(preds)
+                self.predictions[mode]['correct_labels'].append(correct)
 
         # TODO: store attentions (all layers)
         # TODO: convert src into words and store them in json
@@ -95,59 +233,98 @@ class Statistics():
 
 
     def get_train_acc(self, level=0):
-        train_acc = self.train['train_accuracy']
-        return np.mean([tr[level] for tr in train_acc])
+        return self.train.mean('train_accuracy_{}'.format(level))
 
     def get_valid_acc(self, level=0, mode='exact'):
-        valid_acc = self.val[mode]['validation_accuracy']
-        return np.mean([tr[level] for tr in valid_acc])
+        return self.val[mode].mean('validation_accuracy_{}'.format(level))
 
     def get_valid_conf(self, level=0, mode='exact'):
-        valid_conf_false = np.mean([tr[level] for tr in self.val[mode]['incorrect_confs']])
-        valid_conf_true = np.mean([tr[level] for tr in self.val[mode]['correct_confs']])
+        valid_conf_false = self.val[mode].mean('incorrect_confs_{}'.format(level))
+        valid_conf_true = self.val[mode].mean('correct_confs_{}'.format(level))
         return valid_conf_true, valid_conf_false
 
+    def get_confusion_matrix(self, level=0, mode='exact'):
+        """
+        :return: (labels + 1) x (labels + 1) counts of the level, summed over all the processes.
+            Rows are the correct labels, columns the predicted ones, the last one is for labels out of the level
+        """
+        confusion = self.confusion[mode][level]
+        return np.asarray(distributed.all_reduce_sum(confusion), dtype=np.int64).reshape(confusion.shape)
+
+    def log_confusion(self, level=0):
+        """
+        Log the validation predictions out of the level, and save the confusion matrices
+        of the level in the experiment folder
+        """
+        confusion = {mode: self.get_confusion_matrix(level, mode) for mode in ['exact', 'overall']}
+        out_of_level = {mode: conf[:, -1].sum() / max(conf.sum(), 1) for mode, conf in confusion.items()}
+        self.info("Validation predictions out of level {} : Exact : {}, Overall : {}".format(
+            level, out_of_level['exact'], out_of_level['overall']))
+        if self.is_main:
+            save_path_base = mu.create_save_dir(self.exp_name)
+            np.savez(os.path.join(save_path_base, 'confusion_epoch_{}_level_{}.npz'.format(self.epoch, level)),
+                     **confusion)
+
+    def info(self, message):
+        if self.is_main:
+            logging.info(message)
+
+    def add_scalar(self, name, value, step):
+        if self.is_main:
+            self.writer.add_scalar(name, value, step)
+
     def log_loss(self):
+        self.flush_train()
         time_taken = time.time() - self.calc_start
         m, s = divmod(time_taken, 60)
         h, m = divmod(m, 60)
-        logging.info('Time taken: {}:{}:{}'.format(h,m,s))
-        logging.info("After Epoch {}".format(self.epoch))
-        train_loss = np.mean(self.train['train_loss'])
-        logging.info("Train Loss : {}".format(train_loss))
-        logging.info("Train Log Loss : {}".format(np.mean(self.train['train_log_loss'])))
-        self.writer.add_scalar('train_loss',train_loss,self.epoch)
-        valid_loss_exact = np.mean(self.val['exact']['validation_loss'])
-        valid_loss_overall = np.mean(self.val['overall']['validation_loss'])
-        logging.info("Validation Loss : Exact : {}, Overall : {}".format(valid_loss_exact, valid_loss_overall))
-        self.writer.add_scalar('validation_loss_exact', valid_loss_exact, self.epoch)
-        self.writer.add_scalar('validation_loss_overall', valid_loss_overall, self.epoch)
+        self.info('Time taken: {}:{}:{}'.format(h,m,s))
+        self.info("After Epoch {}".format(self.epoch))
+        train_loss = self.train.mean('train_loss')
+        self.info("Train Loss : {}".format(train_loss))
+        self.info("Train Log Loss : {}".format(self.train.mean('train_log_loss')))
+        self.add_scalar('train_loss',train_loss,self.epoch)
+        real_tokens = self.train.total('real_tokens')
+        padded_tokens = self.train.total('padded_tokens')
+        if padded_tokens > 0:
+            padding_efficiency = real_tokens / padded_tokens
+            self.info("Train padding efficiency : {}".format(padding_efficiency))
+            self.add_scalar('train_padding_efficiency', padding_efficiency, self.epoch)
+        valid_loss_exact = self.val['exact'].mean('validation_loss')
+        valid_loss_overall = self.val['overall'].mean('validation_loss')
+        self.info("Validation Loss : Exact : {}, Overall : {}".format(valid_loss_exact, valid_loss_overall))
+        self.add_scalar('validation_loss_exact', valid_loss_exact, self.epoch)
+        self.add_scalar('validation_loss_overall', valid_loss_overall, self.epoch)
         for level in range(self.max_levels):
-            logging.info("Train accuracy for level {} : {}".format(
-                level, self.get_train_acc(level)))
-            self.writer.add_scalar('train_acc_{}'.format(level),
-                                   self.get_train_acc(level), self.epoch)
-            logging.info("Validation accuracy, Mode: exact, for level {} : {}".format(
-                level, self.get_valid_acc(level, mode='exact')))
-            self.writer.add_scalar('valid_acc_exact_{}'.format(level),
-                                   self.get_valid_acc(level, mode='exact'), self.epoch)
+            train_acc = self.get_train_acc(level)
+            valid_acc_e = self.get_valid_acc(level, mode='exact')
+            valid_acc_o = self.get_valid_acc(level, mode='overall')
+            self.info("Train accuracy for level {} : {}".format(
+                level, train_acc))
+            self.add_scalar('train_acc_{}'.format(level),
+                                   train_acc, self.epoch)
+            self.info("Validation accuracy, Mode: exact, for level {} : {}".format(
+                level, valid_acc_e))
+            self.add_scalar('valid_acc_exact_{}'.format(level),
+                                   valid_acc_e, self.epoch)
             valid_conf_true_e, valid_conf_false_e = self.get_valid_conf(level, mode='exact')
             valid_conf_true_o, valid_conf_false_o = self.get_valid_conf(level, mode='overall')
-            logging.info("Validation accuracy, Mode: overall, for level {} : {}".format(
-                level, self.get_valid_acc(level, mode='overall')))
-            self.writer.add_scalar('valid_acc_exact_{}'.format(level),
-                                   self.get_valid_acc(level, mode='overall'), self.epoch)
+            self.info("Validation accuracy, Mode: overall, for level {} : {}".format(
+                level, valid_acc_o))
+            self.add_scalar('valid_acc_exact_{}'.format(level),
+                                   valid_acc_o, self.epoch)
 
-            logging.info("Validation correct confidence for level {} :  Exact : {}, Overall : {}".format(
+            self.info("Validation correct confidence for level {} :  Exact : {}, Overall : {}".format(
                 level, valid_conf_true_e, valid_conf_true_o
             ))
-            logging.info("Validation incorrect confidence for level {} : Exact : {}, Overall : {}".format(
+            self.info("Validation incorrect confidence for level {} : Exact : {}, Overall : {}".format(
                 level, valid_conf_false_e, valid_conf_false_o
             ))
-            self.writer.add_scalar('valid_conf_exact_{}'.format(level), valid_conf_true_e, self.epoch)
-            self.writer.add_scalar('valid_conf_exact_{}'.format(level), valid_conf_false_e, self.epoch)
-            self.writer.add_scalar('valid_conf_overall_{}'.format(level), valid_conf_true_o, self.epoch)
-            self.writer.add_scalar('valid_conf_overall_{}'.format(level), valid_conf_false_o, self.epoch)
+            self.add_scalar('valid_conf_exact_{}'.format(level), valid_conf_true_e, self.epoch)
+            self.add_scalar('valid_conf_exact_{}'.format(level), valid_conf_false_e, self.epoch)
+            self.add_scalar('valid_conf_overall_{}'.format(level), valid_conf_true_o, self.epoch)
+            self.add_scalar('valid_conf_overall_{}'.format(level), valid_conf_false_o, self.epoch)
+            self.log_confusion(level)
 
             """
             if level==0:
@@ -162,33 +339,21 @@ class Statistics():
         #self.reset()
 
     def reset(self):
-        self.train = {
-            'train_loss': [],
-            'train_accuracy': [],
-            'train_log_loss': []
-        }
-        self.val = {
-            'exact': {
-                'validation_loss': [],
-                'validation_log_loss': [],
-                'validation_accuracy': [],
-                'predicted_labels': [],
-                'correct_labels': [],
-                'correct_confs': [],
-                'incorrect_confs': []
-            },
-            'overall': {
-                'validation_loss': [],
-                'validation_log_loss': [],
-                'validation_accuracy': [],
-                'predicted_labels': [],
-                'correct_labels': [],
-                'correct_confs': [],
-                'incorrect_confs': []
-            }
-        }
+        self.train = MetricAccumulator()
+        # training metrics summed on device since the last flush_train
+        self.device_sums = None
+        self.device_steps = 0
+        self.val = {mode: MetricAccumulator() for mode in ['exact', 'overall']}
+        self.confusion = {mode: [np.zeros((size + 1, size + 1), dtype=np.int64)
+                                 for _, size in self.label_ranges]
+                          for mode in ['exact', 'overall']}
+        # raw predictions, only kept if keep_predictions
+        self.predictions = {mode: {'predicted_labels': [], 'correct_labels': []}
+                            for mode in ['exact', 'overall']}
 
     def __del__(self):
+        if self.writer is None:
+            return
         log_path = os.path.join(self.log_dir, '{}_all_scalars.json'.format(self.exp_name))
         self.writer.export_scalars_to_json(log_path)
         self.writer.close()
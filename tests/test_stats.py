@@ -0,0 +1,52 @@
+# Confusion counts of the validation statistics
+import os
+import shutil
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from codes.utils import model_utils as mu
+from codes.utils.stats import Statistics
+
+
+@pytest.fixture
+def make_stats():
+    created = []
+
+    def make(level=-1, max_levels=2):
+        # 2 classes on the first level, 3 on the second
+        label2id = {'l0_0': 1, 'l0_1': 2, 'l1_0': 3, 'l1_1': 4, 'l1_2': 5}
+        data = SimpleNamespace(label2id=label2id, train_indices=[], test_indices=[])
+        stats = Statistics(max_levels=max_levels, exp_name='test_stats', data=data, level=level)
+        stats.next()
+        created.append(stats)
+        return stats
+
+    yield make
+    for stats in created:
+        stats.writer.close()
+        stats.writer = None
+        shutil.rmtree(os.path.join(stats.log_dir, stats.exp_name), ignore_errors=True)
+    shutil.rmtree(mu.create_save_dir('test_stats'), ignore_errors=True)
+
+
+def test_confusion_all_levels(make_stats):
+    stats = make_stats()
+    assert stats.label_ranges == [(1, 2), (3, 3)]
+    stats.update_confusion([np.array([1, 2, 4]), np.array([3, 5, 1])],
+                           [np.array([1, 1, 2]), np.array([3, 5, 4])])
+    assert stats.confusion['exact'][0].tolist() == [[1, 1, 0], [0, 0, 1], [0, 0, 0]]
+    assert stats.confusion['exact'][1].tolist() == [[1, 0, 0, 0], [0, 0, 0, 1], [0, 0, 1, 0], [0, 0, 0, 0]]
+
+
+def test_confusion_single_level(make_stats):
+    # with a single level, the targets and predictions are the class ids of the level
+    stats = make_stats(level=1, max_levels=1)
+    assert stats.label_ranges == [(0, 3)]
+    stats.update_confusion([np.array([0, 2, 2, 1])], [np.array([0, 2, 1, 1])])
+    assert stats.confusion['exact'][0].tolist() == [[1, 0, 0, 0], [0, 1, 1, 0], [0, 0, 1, 0], [0, 0, 0, 0]]
+    assert stats.get_confusion_matrix(0)[:, -1].sum() == 0
+    stats.log_confusion(0)
+    saved = np.load(os.path.join(mu.create_save_dir('test_stats'), 'confusion_epoch_0_level_0.npz'))
+    assert saved['exact'].tolist() == stats.confusion['exact'][0].tolist()
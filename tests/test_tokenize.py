@@ -0,0 +1,50 @@
+# Tokenization of sentence tokenized (<sent>) texts
+import pandas
+
+from codes.app.server import Predictor
+from codes.utils import constants
+from codes.utils.data import Data_Utility, tokenize_shard
+
+
+def make_data(clean=True):
+    # char tokenization splits on spaces, so that no nltk data is needed
+    data = Data_Utility.__new__(Data_Utility)
+    data.clean = clean
+    data.tokenization = 'char'
+    data.max_word_doc = -1
+    data.preprocess_workers = 1
+    return data
+
+
+def test_tokenize_is_flat():
+    for clean in [True, False]:
+        tokens = make_data(clean).tokenize('<sent> foo bar <sent> baz')
+        assert len(tokens) > 0
+        assert all(isinstance(t, str) for t in tokens)
+
+
+def test_tokenize_shard_is_flat():
+    docs, items = tokenize_shard(['first doc <sent> second sentence', 'plain doc'],
+                                 clean=True, tokenization='char')
+    assert all(isinstance(t, str) for doc in docs for t in doc)
+    assert docs[1] == ['plain', 'doc']
+    assert items['plain'] == 1
+
+
+def test_server_encode_sentence_tokenized():
+    predictor = Predictor.__new__(Predictor)
+    predictor.data = make_data()
+    predictor.data.word2id = {constants.PAD_WORD: 0, constants.UNK_WORD: 1, 'foo': 2}
+    predictor.unk = 1
+    assert predictor.encode('<sent> foo') == [2]
+    assert predictor.encode('<sent>') == [1]
+
+
+def test_wiki_rows_split_sentences():
+    data = make_data()
+    df = pandas.DataFrame({'l1': ['a'], 'l2': ['b'], 'l3': ['c'], 'text': ['one two<sent>three']})
+    y_class2id = {'l1': {}, 'l2': {}, 'l3': {}}
+    texts, row_classes = data.read_wiki_rows(df, y_class2id)
+    assert row_classes == [[0, 0, 0]]
+    docs, _ = data.tokenize_documents(texts)
+    assert docs == [['one', 'two', 'three']]